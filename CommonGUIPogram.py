@@ -37,8 +37,12 @@ import benfords_law as benford
 import SIR as sir
 import pearson_test as pearson
 import Spearman_corr as sperman
+from result_cache import ResultCache
+
+cache = ResultCache()
 
 def startAnalytics(title, path):
+    """Runs all modules for one table, returns an error message or None"""
     try:
         print("Start " + title)
 
@@ -49,20 +53,81 @@ def startAnalytics(title, path):
         sperman.Spearman(title, path).train()
 
         # print("SIR")
-        # sir.Learner(title, path, sir.loss, 140).train()
+        # sir.Learner(title, path, sir.loss, 140, cache=cache).train()
         print("Pearson (sir)")
-        pearson.Pearson(title).train()
+        pearson.Pearson(title, cache).train()
 
         print(title + " completed\n")
+        return None
 
-    except Exception as error:
+    except (Exception, SystemExit) as error:
         print("Title: " + title + "\tError: " + str(error) + "\n")
+        return str(error)
+
+#
+#   Background analytics
+#
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import get_context
+from contextlib import redirect_stdout
+from timeit import default_timer as timer
+import threading
+import io
+
+def analyzeTable(title, path):
+    """startAnalytics in a worker process, returns (title, error message or None, seconds, printed output)"""
+    start = timer()
+    output = io.StringIO()
+    with redirect_stdout(output):
+        error = startAnalytics(title, path)
+    return title, error, timer() - start, output.getvalue()
+
+class AnalyticsRun(object):
+    """
+    Tables analysed by a pool of worker processes. A background thread submits them and sends every finished
+    table to the window as a -TABLE DONE- event with (done, total, analyzeTable result), -ANALYTICS DONE- with
+    (done, total, cancelled) comes after the last table or after cancel. Cancel drops tables which did not start,
+    tables already running are finished and sent as usual
+    """
+    def __init__(self, window, tables, workers=None):
+        self.window = window
+        self.tables = tables
+        self.workers = workers or os.cpu_count() or 1
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        done = 0
+        # spawned workers do not inherit the GUI toolkit state of this process
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"),
+                                 initializer=sir.use_agg_backend) as executor:
+            futures = {executor.submit(analyzeTable, title, path): title for title, path in self.tables}
+            pending = set(futures)
+            while pending:
+                if self.cancelled.is_set():
+                    # tables which did not start are dropped, the running ones are still waited for and sent
+                    pending = {future for future in pending if not future.cancel()}
+                finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done += 1
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        result = (futures[future], f"{error.__class__.__name__}: {error}", 0, "")
+                    self.window.write_event_value("-TABLE DONE-", (done, len(futures), result))
+        self.window.write_event_value("-ANALYTICS DONE-", (done, len(self.tables), self.cancelled.is_set()))
 
 #
 #   Data aggregation
 #   
 import json
-from collections import defaultdict
 import pandas as pd
 
 def getJsonsByPattern(patternBegining):
@@ -77,7 +142,8 @@ def getJsonsByPattern(patternBegining):
     return jsonFiles
 
 def aggregateDataFromJsonFiles(jsonFiles):
-    commonData = defaultdict(list)
+    """Column -> values of all files, a key missing in some of them (older results, no death data) is None there"""
+    rows = []
     countries = sorted(jsonFiles.keys())
     for country in countries:
         path = jsonFiles[country]
@@ -87,10 +153,9 @@ def aggregateDataFromJsonFiles(jsonFiles):
         except:
             print("There is no file {} -- train func".format(path))
             continue
-        commonData["country"].append(country)
-        for key in data:
-            commonData[key].append(data[key])
-    return commonData
+        rows.append(dict(data, country=country))
+    keys = dict.fromkeys(["country"] + [key for row in rows for key in row])
+    return {key: [row.get(key) for row in rows] for key in keys}
     
 def aggregateDataToCommonCsv():
     commonDataFolderName = "CommonDataAnalytics"
@@ -115,63 +180,112 @@ import PySimpleGUI as sg
 import os.path
 
 defaultButtonColor = ('black', '#D9D9D9')
-fileListColumn = [
-    [
-        sg.Input(size=(65, 13), key="-FOLDER_BROWSING-", default_text=dirName, enable_events=True, visible=True),
-        sg.FolderBrowse("Browse data folder", initial_folder=dirName, key="-FOLDER_BROWSING-", button_color=defaultButtonColor),
-    ],
-    [
-        sg.Listbox(values=dataTables, enable_events=True, size=(80, 20), key="-FILE LIST-", select_mode="multiple")
-    ],
-]
-
-buttonsColumn = [
-    [sg.Button("Start data analytics", button_color=defaultButtonColor)],
-    [sg.Button("Start full data analytics", button_color=defaultButtonColor)],
-    [sg.Button("Aggregate data analytics", button_color=defaultButtonColor)]
-]
-
-layout = [
-    [
-        sg.Column(fileListColumn),
-        sg.VSeperator(),
-        sg.Column(buttonsColumn),
+
+def createWindow():
+    fileListColumn = [
+        [
+            sg.Input(size=(65, 13), key="-FOLDER_BROWSING-", default_text=dirName, enable_events=True, visible=True),
+            sg.FolderBrowse("Browse data folder", initial_folder=dirName, key="-FOLDER_BROWSING-", button_color=defaultButtonColor),
+        ],
+        [
+            sg.Listbox(values=dataTables, enable_events=True, size=(80, 20), key="-FILE LIST-", select_mode="multiple")
+        ],
+    ]
+
+    buttonsColumn = [
+        [sg.Button("Start data analytics", button_color=defaultButtonColor)],
+        [sg.Button("Start full data analytics", button_color=defaultButtonColor)],
+        [sg.Button("Cancel", button_color=defaultButtonColor, disabled=True)],
+        [sg.Button("Aggregate data analytics", button_color=defaultButtonColor)],
+        [sg.ProgressBar(1, orientation="h", size=(20, 15), key="-PROGRESS-")],
+        [sg.Text("", size=(30, 1), key="-STATUS-")],
+    ]
+
+    layout = [
+        [
+            sg.Column(fileListColumn),
+            sg.VSeperator(),
+            sg.Column(buttonsColumn),
+        ],
+        [
+            sg.Multiline(size=(120, 12), key="-LOG-", autoscroll=True, disabled=True)
+        ],
     ]
-]
 
-appFont = (12)
-sg.set_options(font=appFont)
-sg.theme("DarkTeal2")
-window = sg.Window("Covid_MIPT", layout)
+    appFont = (12)
+    sg.set_options(font=appFont)
+    sg.theme("DarkTeal2")
+    return sg.Window("Covid_MIPT", layout)
+
+def setRunning(window, running):
+    window["Start data analytics"].update(disabled=running)
+    window["Start full data analytics"].update(disabled=running)
+    window["Cancel"].update(disabled=not running)
+
+def startRun(window, tables):
+    window["-LOG-"].update("")
+    window["-PROGRESS-"].update(0, max=max(len(tables), 1))
+    window["-STATUS-"].update(f"0/{len(tables)} tables")
+    setRunning(window, True)
+    return AnalyticsRun(window, tables).start()
 
 #
 #   Layout loop
 #
-while True:
-    event, values = window.Read()
-    if event == "Exit" or event == sg.WIN_CLOSED:
-        break
-    elif event == "-FOLDER_BROWSING-":
-        newValue = values["-FOLDER_BROWSING-"]
-        if newValue != dirName and newValue != "":
-            dirName = values["-FOLDER_BROWSING-"]
-            print("Switch dir to:\t" + dirName)
-            dataTablesPaths = getAllDatatablesFromFolder(dirName)
-            dataTables = trimDataTablesPaths(dataTablesPaths, len(dirName))
-            window["-FILE LIST-"].update(dataTables)
-
-    elif event == "Start data analytics": 
-        for selectedItem in values["-FILE LIST-"]:
-            index = dataTables.index(selectedItem)
-            startAnalytics(selectedItem, dataTablesPaths[index])
-        window['-FILE LIST-'].set_value([])
-
-    elif event == "Start full data analytics":
-        for selectedItem in dataTables:
-            index = dataTables.index(selectedItem)
-            startAnalytics(selectedItem, dataTablesPaths[index])
-    
-    elif event == "Aggregate data analytics":
-        aggregateDataToCommonCsv()
+def main():
+    global dirName, dataTablesPaths, dataTables
+
+    window = createWindow()
+    run = None
+    while True:
+        event, values = window.Read()
+        if event == "Exit" or event == sg.WIN_CLOSED:
+            break
+        elif event == "-FOLDER_BROWSING-":
+            newValue = values["-FOLDER_BROWSING-"]
+            if newValue != dirName and newValue != "":
+                dirName = values["-FOLDER_BROWSING-"]
+                print("Switch dir to:\t" + dirName)
+                dataTablesPaths = getAllDatatablesFromFolder(dirName)
+                dataTables = trimDataTablesPaths(dataTablesPaths, len(dirName))
+                window["-FILE LIST-"].update(dataTables)
+
+        elif event == "Start data analytics" and run is None:
+            tables = [(selectedItem, dataTablesPaths[dataTables.index(selectedItem)])
+                      for selectedItem in values["-FILE LIST-"]]
+            if tables:
+                run = startRun(window, tables)
+            window['-FILE LIST-'].set_value([])
+
+        elif event == "Start full data analytics" and run is None:
+            run = startRun(window, list(zip(dataTables, dataTablesPaths)))
+
+        elif event == "Cancel" and run is not None:
+            run.cancel()
+            window["Cancel"].update(disabled=True)
+            window["-STATUS-"].update("Cancelling, running tables finish")
+
+        elif event == "-TABLE DONE-":
+            done, total, (title, error, seconds, output) = values[event]
+            window["-PROGRESS-"].update(done)
+            window["-STATUS-"].update(f"{done}/{total} tables")
+            window["-LOG-"].print(f"[{done}/{total}] {title}: {'failed -- ' + error if error else 'done'} in {seconds:.2f}s")
+            window["-LOG-"].print(output, end="")
+
+        elif event == "-ANALYTICS DONE-":
+            done, total, cancelled = values[event]
+            window["-STATUS-"].update(f"{'Cancelled' if cancelled else 'Finished'}: {done}/{total} tables")
+            setRunning(window, False)
+            run = None
+
+        elif event == "Aggregate data analytics":
+            aggregateDataToCommonCsv()
+
+    if run is not None:
+        run.cancel()
+        run.thread.join()
+    window.close()
+
 
-window.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,31 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from datetime import timedelta, datetime
 from scipy.integrate import odeint
 from scipy.optimize import minimize
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from timeit import default_timer as timer
 from population_dict import population_dict
+from data_store import load_columns, stringency_series, save_artifact, STRINGENCY_PATH
+from result_cache import ResultCache, content_key, CACHE_FOLDER
 import argparse
 import sys
 import os
 import json
 
 
+INITIAL_GUESS = [0.4, 0.05]
+BOUNDS = [(0.00000001, 0.4), (0.00000001, 0.4)]
+ALPHA = 0.8
+GRID_SIZE = 32
+GRID_STARTS = 3
+GRID_LEVELS = 2
+PERCENTILES = [5, 50, 95]
+STEP_SCALES = [1, 2, 4, 8, 16]
+BETA_WINDOW = 28
+STRINGENCY_LAG = 14
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
@@ -19,7 +34,8 @@ def parse_arguments():
         action='store',
         dest='countries',
         help='Name of country/countries separated by comma without spaces' +
-             'It must exact match the data names or you will get out of bonds error.',
+             'It must exact match the data names or you will get out of bonds error. ' +
+             'all means every Data/Covid*.csv file.',
         metavar='COUNTRY_NAMES',
         type=str,
         default="")
@@ -42,30 +58,197 @@ def parse_arguments():
         type=int,
         default=140)
 
+    parser.add_argument(
+        '--model',
+        required=False,
+        dest='model',
+        help='Compartmental model from SIR.MODELS: SIR, SIRD (fits deaths too) or SEIR. '
+             'Results are put to <MODEL>/<country>/. Default is SIR',
+        choices=list(MODELS),
+        default='SIR')
+
+    parser.add_argument(
+        '--beta',
+        required=False,
+        dest='beta',
+        help='constant beta, piecewise constant beta over windows of --beta-window days or beta reduced by '
+             'the stringency index of --stringency-lag days before (all_restrictions/Stringency<country>.csv). '
+             'Time-varying beta is integrated with rk4, results are put to <MODEL>_<BETA>/<country>/. '
+             'Default is constant',
+        choices=['constant', 'piecewise', 'stringency'],
+        default='constant')
+
+    parser.add_argument(
+        '--beta-window',
+        required=False,
+        dest='beta_window',
+        help=f'Days of one piece of piecewise beta. Defaults to {BETA_WINDOW}',
+        metavar='DAYS',
+        type=int,
+        default=BETA_WINDOW)
+
+    parser.add_argument(
+        '--stringency-lag',
+        required=False,
+        dest='stringency_lag',
+        help=f'Days between a change of the stringency index and its effect on beta. Defaults to {STRINGENCY_LAG}',
+        metavar='DAYS',
+        type=int,
+        default=STRINGENCY_LAG)
+
+    parser.add_argument(
+        '--engine',
+        required=False,
+        dest='engine',
+        help='Integrator of the SIR equations: odeint or rk4 (fixed step, vectorized over parameter sets). '
+             'It only changes the fit, which probes few points at a time and is slower with rk4; '
+             '--grid-init and --bootstrap always use batched rk4. Default is odeint',
+        choices=['odeint', 'rk4'],
+        default='odeint')
+
+    parser.add_argument(
+        '--workers',
+        required=False,
+        dest='workers',
+        help='Number of processes fitting countries in parallel. Defaults to 1',
+        metavar='WORKERS',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '--warm-start',
+        action='store_true',
+        dest='warm_start',
+        help='Start the fit from beta, gamma saved in SIR/<country>/data.json '
+             'and refit only countries with new days')
+
+    parser.add_argument(
+        '--grid-init',
+        action='store_true',
+        dest='grid_init',
+        help='Evaluate the loss over a coarse to fine (beta, gamma) grid in batched rk4 integrations and start '
+             'the fit from the best cells. The loss surface is saved to SIR/<country>/loss_surface.npz')
+
+    parser.add_argument(
+        '--grid-size',
+        required=False,
+        dest='grid_size',
+        help=f'Number of beta and of gamma values of each grid level. Defaults to {GRID_SIZE}',
+        metavar='GRID_SIZE',
+        type=int,
+        default=GRID_SIZE)
+
+    parser.add_argument(
+        '--grid-starts',
+        required=False,
+        dest='grid_starts',
+        help=f'Number of best grid cells the fit is started from (besides the usual initial guess). '
+             f'Defaults to {GRID_STARTS}',
+        metavar='GRID_STARTS',
+        type=int,
+        default=GRID_STARTS)
+
+    parser.add_argument(
+        '--bootstrap',
+        required=False,
+        dest='bootstrap',
+        help='Number of residual bootstrap samples refitted together with vectorized rk4 integrations, their '
+             f'{PERCENTILES[0]}-{PERCENTILES[-1]} percentile bands are put to data.json and the plot. Defaults to 0',
+        metavar='K',
+        type=int,
+        default=0)
+
+    parser.add_argument(
+        '--artifact',
+        required=False,
+        dest='artifact',
+        help='Format of fact and predicted series: json lists in data.json, or npy rows of one float64 '
+             'arrays.npy (NaN for missing days) next to a data.json with the rest. Default is json',
+        choices=['json', 'npy'],
+        default='json')
+
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        dest='cache',
+        help='Skip countries whose data and fit parameters did not change since the cached fit')
+
+    parser.add_argument(
+        '--cache-folder',
+        required=False,
+        dest='cache_folder',
+        help='Folder of the result cache. Default is ' + CACHE_FOLDER,
+        metavar='CACHE_FOLDER',
+        type=str,
+        default=CACHE_FOLDER)
+
+    parser.add_argument(
+        '--cache-size',
+        required=False,
+        dest='cache_size',
+        help='Size limit of the result cache in megabytes, least recently used results are removed. '
+             'Defaults to 256',
+        metavar='CACHE_SIZE',
+        type=int,
+        default=256)
+
     args = parser.parse_args()
 
     try:
         countries_raw = args.countries
-        country_list = countries_raw.split(",")
+        country_list = all_countries() if countries_raw == 'all' else countries_raw.split(",")
     except Exception:
         sys.exit("QUIT: countries parameter are not in correct format")
 
-    return country_list, args.file_path, args.predict_range
+    if args.grid_size < 2 or args.grid_starts < 1:
+        sys.exit("QUIT: grid size must be at least 2 and grid starts at least 1")
+    if args.bootstrap < 0:
+        sys.exit("QUIT: number of bootstrap samples can not be negative")
+    if args.beta_window < 1 or args.stringency_lag < 0:
+        sys.exit("QUIT: beta window must be positive and stringency lag can not be negative")
+
+    beta = None
+    if args.beta == 'piecewise':
+        beta = {'mode': 'piecewise', 'window': args.beta_window}
+    elif args.beta == 'stringency':
+        beta = {'mode': 'stringency', 'lag': args.stringency_lag}
+
+    learner_options = {'model': args.model, 'engine': args.engine, 'warm_start': args.warm_start,
+                       'grid': {'size': args.grid_size, 'starts': args.grid_starts} if args.grid_init else None,
+                       'bootstrap': args.bootstrap, 'beta': beta, 'artifact': args.artifact,
+                       'cache': ResultCache(args.cache_folder, args.cache_size * 2 ** 20) if args.cache else None}
+    return country_list, args.file_path, args.predict_range, args.workers, learner_options
+
+
+def all_countries(data_folder='Data'):
+    return sorted(name[len('Covid'):-len('.csv')] for name in os.listdir(data_folder)
+                  if name.startswith('Covid') and name.endswith('.csv'))
 
 
-def extend_index(country_name: str, new_size, file_path):
-    file_name = str(file_path).capitalize()
+def load_series(file_path, names=('infected', 'recovered')):
+    """
+    Days (datetime64[D]) and float series infected, recovered (total cases - infected) of a country,
+    death only if it is among names: some countries have no total_death and plain SIR does not need it.
+    The file is read once, the series are shared by Learner.train, Learner.predict and the losses
+    """
     try:
-        data = pd.read_csv(file_path)
-        current = datetime.strptime(data.iloc[0]['time'], '%Y-%m-%d')
-        values = np.array([datetime.strftime(current, '%Y-%m-%d')])
-        while len(values) < new_size:
-            current = current + timedelta(days=1)
-            values = np.append(values, datetime.strftime(current, '%Y-%m-%d'))
+        columns = load_columns(file_path)
+    except OSError:
+        sys.exit("There is no file {} -- load_series func".format(file_path))
+    try:
+        infected = np.asarray(columns['total_currently_infected'], dtype=float)
+        series = {'time': np.asarray(columns['time']), 'infected': infected,
+                  'recovered': np.asarray(columns['total_cases'], dtype=float) - infected}
+        if 'death' in names:
+            series['death'] = np.asarray(columns['total_death'], dtype=float)
+    except KeyError as error:
+        sys.exit("There is no column {} in {} -- load_series func".format(error, file_path))
+    return series
+
 
-        return values
-    except:
-        sys.exit("There is no file {} -- extend_index func".format(file_name))
+def extend_index(first_day, new_size):
+    """new_size days from first_day as datetime64[D]"""
+    return np.datetime64(first_day, 'D') + np.arange(new_size)
 
 
 def SIR(state, t, N, beta, gamma):
@@ -81,12 +264,257 @@ def SIR(state, t, N, beta, gamma):
     return dSdt, dIdt, dRdt
 
 
+def SIRD(state, t, N, beta, gamma, mu):
+    """SIR with deaths: mu - mortality rate of infected"""
+    S, I, R, D = state
+
+    dSdt = -beta * S * I / N
+
+    dIdt = beta * S * I / N - gamma * I - mu * I
+
+    dRdt = gamma * I
+
+    dDdt = mu * I
+
+    return dSdt, dIdt, dRdt, dDdt
+
+
+def SEIR(state, t, N, beta, sigma, gamma):
+    """SIR with exposed (infected, not yet infectious) compartment: sigma - 1 / incubation period"""
+    S, E, I, R = state
+
+    dSdt = -beta * S * I / N
+
+    dEdt = beta * S * I / N - sigma * E
+
+    dIdt = sigma * E - gamma * I
+
+    dRdt = gamma * I
+
+    return dSdt, dEdt, dIdt, dRdt
+
+
+def SIR_sensitivity(state, t, N, beta, gamma):
+    """
+    SIR with forward sensitivities: S, I, R, their derivatives by beta (S_b, I_b, R_b)
+    and by gamma (S_g, I_g, R_g), all derivatives are 0 at t = 0
+    """
+    S, I, R, S_b, I_b, R_b, S_g, I_g, R_g = state
+
+    infection = beta * S * I / N
+    dSdt, dIdt, dRdt = -infection, infection - gamma * I, gamma * I
+
+    infection_b = beta * (I * S_b + S * I_b) / N + S * I / N
+    dS_bdt, dI_bdt, dR_bdt = -infection_b, infection_b - gamma * I_b, gamma * I_b
+
+    infection_g = beta * (I * S_g + S * I_g) / N
+    dS_gdt, dI_gdt, dR_gdt = -infection_g, infection_g - gamma * I_g - I, gamma * I_g + I
+
+    return dSdt, dIdt, dRdt, dS_bdt, dI_bdt, dR_bdt, dS_gdt, dI_gdt, dR_gdt
+
+
+def rk4(rhs, state, size, args=(), substeps=2):
+    """
+    Fixed step Runge-Kutta 4 for days 0..size-1 with `substeps` steps per day, rhs has odeint signature.
+    Parameters in args may be arrays of one shape: all parameter sets are advanced at once
+    and the result has shape (size, len(state), *shape) instead of (size, len(state)).
+    A single parameter set is advanced with python floats, which is much cheaper than tiny arrays
+    """
+    shape = np.broadcast(*args).shape
+    y = [np.full(shape, value, dtype=float) for value in state] if shape else [float(value) for value in state]
+    args = tuple(arg if np.ndim(arg) else float(arg) for arg in args)
+    h = 1 / substeps
+    t = 0.0
+    trajectory = [y]
+    for day in range(1, size):
+        for _ in range(substeps):
+            k1 = rhs(y, t, *args)
+            k2 = rhs([v + h / 2 * d for v, d in zip(y, k1)], t + h / 2, *args)
+            k3 = rhs([v + h / 2 * d for v, d in zip(y, k2)], t + h / 2, *args)
+            k4 = rhs([v + h * d for v, d in zip(y, k3)], t + h, *args)
+            y = [v + h / 6 * (d1 + 2 * (d2 + d3) + d4) for v, d1, d2, d3, d4 in zip(y, k1, k2, k3, k4)]
+            t += h
+        trajectory.append(y)
+    return np.array(trajectory)
+
+
+def integrate(state, size, args, engine='odeint', rhs=SIR):
+    """S, I, R (or all variables of rhs) for days 0..size-1 (columns of the result)"""
+    if engine == 'rk4':
+        return rk4(rhs, state, size, args)
+    return odeint(rhs, state, range(0, size), args=args)
+
+
+def pad_nan(values, size):
+    """Float copy of values cut or padded with NaN to size"""
+    padded = np.full(size, np.nan)
+    padded[:min(size, len(values))] = values[:size]
+    return padded
+
+
+def load_saved_fit(folder_path):
+    """Content of folder_path/data.json, {} if there is no such file"""
+    try:
+        with open(folder_path + 'data.json') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+class PiecewiseBeta(object):
+    """beta of day t is the beta of its window of `window` days, the last one continues into the forecast"""
+    name = 'piecewise'
+
+    def __init__(self, window, segments):
+        self.window = window
+        self.segments = segments
+        self.parameters = [f'beta_{segment}' for segment in range(segments)]
+
+    def __call__(self, t, params):
+        return params[min(int(t // self.window), self.segments - 1)]
+
+    def bounds(self, beta_bounds):
+        return [beta_bounds] * self.segments
+
+    def guess(self, beta):
+        return [beta] * self.segments
+
+
+class StringencyBeta(object):
+    """beta * (1 - effect * stringency index of `lag` days before / 100), the index is constant during a day"""
+    name = 'stringency'
+    parameters = ['beta', 'stringency_effect']
+
+    def __init__(self, stringency, lag):
+        self.stringency = np.asarray(stringency, dtype=float)
+        self.lag = lag
+
+    def __call__(self, t, params):
+        beta, effect = params[:2]
+        day = min(max(int(t) - self.lag, 0), len(self.stringency) - 1)
+        return beta * (1 - effect * self.stringency[day] / 100)
+
+    def bounds(self, beta_bounds):
+        return [beta_bounds, (0, 1)]
+
+    def guess(self, beta):
+        return [beta, 0]
+
+
+class TimeVaryingRHS(object):
+    """rhs of a model with beta (its first parameter) replaced by schedule(t, parameters of the schedule)"""
+    def __init__(self, rhs, schedule):
+        self.rhs = rhs
+        self.schedule = schedule
+
+    def __call__(self, state, t, N, *params):
+        size = len(self.schedule.parameters)
+        return self.rhs(state, t, N, self.schedule(t, params[:size]), *params[size:])
+
+
+def time_varying_model(model, schedule):
+    return Model(f'{model.name}_{schedule.name}', TimeVaryingRHS(model.rhs, schedule), model.compartments,
+                 schedule.parameters + model.parameters[1:], schedule.bounds(model.bounds[0]) + model.bounds[1:],
+                 schedule.guess(model.initial_guess[0]) + model.initial_guess[1:])
+
+
+def load_stringency(country, start, size, file_path=STRINGENCY_PATH):
+    """Stringency index of size days from start, 0 before the first known day, the last known value after it"""
+    try:
+        days, index = stringency_series(country, file_path)
+    except OSError:
+        sys.exit("There is no file {}{}.csv -- load_stringency func".format(file_path, str(country).capitalize()))
+    known = ~np.isnan(index)
+    days, index = days[known], index[known]
+    if not len(days):
+        return np.zeros(size)
+    order = np.argsort(days)
+    days, index = days[order], index[order]
+    last = np.searchsorted(days, np.datetime64(start, 'D') + np.arange(size), side='right') - 1
+    return np.where(last >= 0, index[np.maximum(last, 0)], 0)
+
+
+def fit_segments(model, data, s_0, i_0, r_0, point):
+    """
+    Warm start for piecewise beta: windows are fitted one after another on the days up to the end of each,
+    betas of earlier windows are fixed, the other parameters start from the previous fit.
+    Every loss is still one rk4 integration of all days so far
+    """
+    schedule = model.rhs.schedule
+    point, days = list(point), len(data['infected'])
+    for segment in range(schedule.segments):
+        end = min((segment + 1) * schedule.window, days)
+        bounds = [(value, value) for value in point[:segment]] + [model.bounds[segment]] + \
+                 [(point[segment], point[segment])] * (schedule.segments - segment - 1) + \
+                 model.bounds[schedule.segments:]
+        optimal = minimize(model_loss_and_gradient, point, jac=True,
+                           args=(model, {name: values[:end] for name, values in data.items()}, s_0, i_0, r_0, 'rk4'),
+                           method='L-BFGS-B', bounds=bounds)
+        point = list(optimal.x)
+        point[segment + 1:schedule.segments] = [point[segment]] * (schedule.segments - segment - 1)
+    return point
+
+
+class Model(object):
+    """
+    Compartmental model fitted by Learner. rhs(state, t, N, *parameters) has odeint signature, compartments start
+    with S and contain I, the other initial compartments are 0 (R is r_0). Infected data are fitted by I,
+    recovered data (total cases - infected) by the sum of compartments after I, deaths by D if the model has it.
+    initial_guess defaults to the middle of bounds. gradient(point, data, s_0, i_0, r_0, engine) -> (loss, gradient)
+    is optional, otherwise central differences are taken over one batched integration
+    """
+    def __init__(self, name, rhs, compartments, parameters, bounds, initial_guess=None, gradient=None,
+                 reproduction_number=None):
+        self.name = name
+        self.rhs = rhs
+        self.compartments = compartments
+        self.parameters = parameters
+        self.bounds = bounds
+        self.initial_guess = initial_guess or [(low + high) / 2 for low, high in bounds]
+        self.gradient = gradient
+        self.reproduction_number = reproduction_number
+        self.series = ['infected', 'recovered'] + (['death'] if 'D' in compartments else [])
+        self.weights = {series: ALPHA if series == 'infected' else (1 - ALPHA) / (len(self.series) - 1)
+                        for series in self.series}
+
+    def initial_state(self, s_0, i_0, r_0):
+        values = {'S': s_0, 'I': i_0, 'R': r_0}
+        return [values.get(name, 0) for name in self.compartments]
+
+    def observables(self, trajectory):
+        """Curves of self.series from a trajectory (days, compartments[, parameter sets])"""
+        infected = self.compartments.index('I')
+        observed = {'infected': trajectory[:, infected], 'recovered': trajectory[:, infected + 1:].sum(axis=1)}
+        if 'death' in self.series:
+            observed['death'] = trajectory[:, self.compartments.index('D')]
+        return observed
+
+    def error(self, trajectory, data):
+        """Weighted sum of RMSE-like errors of the series, ALPHA for infected as in sir_error"""
+        observed = self.observables(trajectory)
+        return sum(weight * series_error(observed[name], data[name]) for name, weight in self.weights.items())
+
+
 class Learner(object):
-    def __init__(self, country_name, file_path, loss, predict_range):
+    def __init__(self, country_name, file_path, loss, predict_range, engine='odeint', cache=None, warm_start=False,
+                 grid=None, model='SIR', bootstrap=0, beta=None, artifact='json'):
         self.country = country_name
-        self.file_path = file_path
+        self.file_path = (file_path if str(file_path).endswith('.csv')
+                          else f'{file_path}{country_name.capitalize()}.csv')
         self.loss = loss
         self.predict_range = predict_range
+        self.engine = 'rk4' if beta else engine
+        self.cache = cache
+        self.warm_start = warm_start
+        self.grid = grid
+        self.bootstrap = bootstrap
+        self.beta = beta
+        self.artifact = artifact
+        try:
+            self.model = self.base_model = MODELS[model]
+        except KeyError:
+            sys.exit(f"Unknown model {model}, available models: {', '.join(MODELS)}")
+        self.stringency = None
         self.i_0 = 2
         self.r_0 = 0
         try:
@@ -94,81 +522,505 @@ class Learner(object):
         except:
             sys.exit("No info about population for {} in population_dict.py".format(self.country))
 
-    def predict(self, beta, gamma, infected, recovered, death, country, s_0, i_0, r_0):
-        new_index = extend_index(country, self.predict_range, self.file_path)
+    def predict(self, params, data, first_day):
+        """Dates, series padded with NaN to predict_range and the trajectory of the model over predict_range days"""
+        new_index = extend_index(first_day, self.predict_range)
         size = len(new_index)
 
-        extended_actual = np.concatenate((infected, [None] * (size - len(infected))))
-        extended_recovered = np.concatenate((recovered, [None] * (size - len(recovered))))
-        extended_death = np.concatenate((death, [None] * (size - len(death))))
+        extended = {name: pad_nan(values, size) for name, values in data.items()}
+        trajectory = integrate(self.model.initial_state(self.s_0, self.i_0, self.r_0), size,
+                               (self.s_0, *params), self.engine, self.model.rhs)
+
+        return new_index, extended, trajectory
+
+    def cache_key(self, data, initial_guess):
+        """Hash of the series and of everything the fit depends on"""
+        return content_key(*[np.asarray(data[name]) for name in self.model.series],
+                           {'s_0': self.s_0, 'i_0': self.i_0, 'r_0': self.r_0, 'predict_range': self.predict_range,
+                            'initial_guess': list(initial_guess), 'bounds': self.model.bounds, 'alpha': ALPHA,
+                            'engine': self.engine, 'grid': self.grid, 'model': self.model.name,
+                            'bootstrap': self.bootstrap, 'percentiles': PERCENTILES, 'beta': self.beta,
+                            'stringency': None if self.stringency is None else self.stringency.tolist()})
+
+    def fit_config(self):
+        """Options of the fit besides the series, the ones hashed by cache_key, as they are stored in data.json"""
+        return json.loads(json.dumps({'engine': self.engine, 'grid': self.grid, 'bootstrap': self.bootstrap,
+                                      'percentiles': PERCENTILES, 'alpha': ALPHA, 'beta': self.beta}))
 
-        S, I, R = odeint(SIR, [s_0, i_0, r_0], range(0, size), args=(s_0, beta, gamma)).T
+    def initial_guess(self, saved, days):
+        """
+        Previous parameters from data.json with warm_start, initial guess of the model otherwise.
+        A window of piecewise beta added since the saved fit starts from the beta of the last saved window.
+        None means neither the series nor the forecast range, the options of the fit (bootstrap, beta...)
+        or the artifact format changed since the saved fit and there is nothing to refit
+        """
+        if not self.warm_start or 'params' not in saved:
+            return self.model.initial_guess
+        fit = saved.get('fit') or {}
+        if (fit.get('days') == days and fit.get('predict_range') == self.predict_range
+                and fit.get('config') == self.fit_config() and self.same_artifact(saved)):
+            return None
+        guess, beta = [], None
+        for name in self.model.parameters:
+            value = saved['params'].get(name, beta if name.startswith('beta_') else None)
+            if value is None:
+                return self.model.initial_guess
+            if name.startswith('beta'):
+                beta = value
+            guess.append(value)
+        return guess
 
-        return new_index, extended_actual, extended_recovered, extended_death, S, I, R
+    def same_artifact(self, saved):
+        """True if the saved data.json is in the format of --artifact (npy keeps series in arrays.npy)"""
+        return ('arrays' in saved) == (self.artifact == 'npy')
+
+    def describe(self, params):
+        return ", ".join(f"{name}={value:.8f}" for name, value in zip(self.model.parameters, params))
+
+    def time_varying_model(self, first_day, days):
+        """Base model with beta of self.beta, the stringency index is aligned to the days of the covid data"""
+        if self.beta['mode'] == 'piecewise':
+            schedule = PiecewiseBeta(self.beta['window'], -(-days // self.beta['window']))
+        else:
+            self.stringency = load_stringency(self.country, first_day, max(days, self.predict_range))
+            schedule = StringencyBeta(self.stringency, self.beta['lag'])
+        return time_varying_model(self.base_model, schedule)
+
+    def optimize(self, model, data, initial_guess, folder_path):
+        """
+        L-BFGS-B from initial_guess, with grid a cold fit also starts from the best grid cells.
+        Returns the best result and the number of grid points
+        """
+        starts, grid_points = [initial_guess], 0
+        if self.grid and initial_guess is model.initial_guess:
+            surfaces = grid_search(model, data, self.s_0, self.i_0, self.r_0, self.grid['size'])
+            starts = best_cells(surfaces, self.grid['starts']) + [model.initial_guess]
+            grid_points = sum(losses.size for axes, losses in surfaces)
+            save_loss_surface(folder_path, model, surfaces)
+
+        optimal = min((minimize(model_loss_and_gradient, start, jac=True,
+                                args=(model, data, self.s_0, self.i_0, self.r_0, self.engine),
+                                method='L-BFGS-B', bounds=model.bounds) for start in starts),
+                      key=lambda result: result.fun)
+        return optimal, grid_points
+
+    def fit_report(self, optimal, initial_guess, days, saved, grid_points=0):
+        """Iterations and evaluations of this fit and of the last cold fit it is compared to"""
+        warm = initial_guess is not self.model.initial_guess
+        cold = (saved.get('fit') or {}) if warm else {'nit': int(optimal.nit), 'nfev': int(optimal.nfev)}
+        report = {'days': days, 'predict_range': self.predict_range, 'nit': int(optimal.nit),
+                  'nfev': int(optimal.nfev), 'warm_start': warm, 'cold_nit': cold.get('cold_nit', cold.get('nit')),
+                  'cold_nfev': cold.get('cold_nfev', cold.get('nfev')), 'grid_points': grid_points,
+                  'config': self.fit_config()}
+        if warm:
+            message = f"country={self.country}, warm start from {self.describe(initial_guess)}: " \
+                      f"{report['nit']} iterations, {report['nfev']} evaluations"
+            if report['cold_nit'] is not None:
+                message += f" (cold fit: {report['cold_nit']} and {report['cold_nfev']}, saved " \
+                           f"{report['cold_nit'] - report['nit']} iterations and " \
+                           f"{report['cold_nfev'] - report['nfev']} evaluations)"
+            print(message)
+        return report
 
     def train(self):
-        file_path = str(self.file_path).capitalize()
-        try:
-            covid_country_info = pd.read_csv(file_path)
-        except:
-            sys.exit("There is no file {} -- train func".format(file_path))
+        series = load_series(self.file_path, self.model.series)
+        first_day, days = series['time'][0], len(series['time'])
+        if self.beta:
+            self.model = self.time_varying_model(first_day, days)
+        model = self.model
+        data = {name: series[name] for name in model.series}
+
+        folder_path = f'{model.name}/{self.country}/'
+        saved = load_saved_fit(folder_path) if self.cache or self.warm_start else {}
+        initial_guess = self.initial_guess(saved, days)
+        if initial_guess is None:
+            print(f"country={self.country}: no new days since the saved fit, it is kept")
+            return
+
+        key = self.cache_key(data, initial_guess) if self.cache else None
+        cached = self.cache.get(model.name.lower(), key) if self.cache else None
+        if cached is not None and saved.get('cache_key') == key and self.same_artifact(saved):
+            print(f"country={self.country}: data and parameters did not change, saved fit is kept")
+            return
 
-        death = covid_country_info['total_death'].values
-        infected = covid_country_info['total_currently_infected'].values
-        total_cases = covid_country_info['total_cases'].values
-        recovered = total_cases - infected
+        if cached is not None:
+            params, trajectory = list(cached['params']), cached['trajectory']
+            fit = json.loads(str(cached['fit'])) if 'fit' in cached else saved.get('fit')
+            extended = {name: pad_nan(values, len(trajectory)) for name, values in data.items()}
+            bands = {name: cached[f'band_{name}'] for name in model.series} if 'param_bands' in cached else None
+            param_bands = cached['param_bands'] if 'param_bands' in cached else None
+        else:
+            if self.beta and initial_guess is model.initial_guess:
+                constant, grid_points = self.optimize(self.base_model, data, self.base_model.initial_guess,
+                                                      folder_path)
+                start = model.rhs.schedule.guess(constant.x[0]) + list(constant.x[1:])
+                if self.beta['mode'] == 'piecewise':
+                    start = fit_segments(model, data, self.s_0, self.i_0, self.r_0, start)
+                optimal, _ = self.optimize(model, data, start, folder_path)
+            else:
+                optimal, grid_points = self.optimize(model, data, initial_guess, folder_path)
+            fit = self.fit_report(optimal, initial_guess, days, saved, grid_points)
 
-        optimal = minimize(loss, [0.4, 0.05], args=(infected, recovered, self.s_0, self.i_0, self.r_0),
-                           method='L-BFGS-B', bounds=[(0.00000001, 0.4), (0.00000001, 0.4)])
+            #
+            params = list(optimal.x)
 
-        #
-        beta, gamma = optimal.x
+            new_index, extended, trajectory = self.predict(params, data, first_day)
+            bands, param_bands = None, None
+            if self.bootstrap:
+                start = timer()
+                ensemble, forecast, iterations = bootstrap(model, params, data, self.s_0, self.i_0, self.r_0,
+                                                           self.bootstrap, len(trajectory))
+                print(f"country={self.country}, bootstrap of {self.bootstrap} samples: {iterations} iterations, "
+                      f"{timer() - start:.2f}s")
+                if np.ptp(ensemble, axis=1).max() > 0:
+                    bands = {name: np.percentile(forecast[name], PERCENTILES, axis=1) for name in model.series}
+                    param_bands = np.percentile(ensemble, PERCENTILES, axis=1)
+                else:
+                    print(f"country={self.country}, warning: all bootstrap samples have the same parameters "
+                          f"{self.describe(ensemble[:, 0])}, no bands are written")
 
-        new_index, extended_actual, extended_recovered, extended_death, S, I, R = self.predict(beta, gamma, infected,
-                                                                                               recovered, death,
-                                                                                               self.country,
-                                                                                               self.s_0, self.i_0,
-                                                                                               self.r_0)
+            if self.cache:
+                values = {'params': np.array(params), 'trajectory': trajectory,
+                          'fit': np.array(json.dumps(fit))}
+                if bands is not None:
+                    values.update({f'band_{name}': band for name, band in bands.items()})
+                    values['param_bands'] = param_bands
+                self.cache.put(model.name.lower(), key, values)
 
-        df = pd.DataFrame(
-            {'Infected data': extended_actual[:self.predict_range],
-             'Recovered data': extended_recovered[:self.predict_range],
-             'I': I, 'R': R
-             })
+        observed = model.observables(trajectory)
+        df = pd.DataFrame({f'{name.capitalize()} data': extended[name][:self.predict_range]
+                           for name in model.series})
+        for index, compartment in enumerate(model.compartments):
+            if compartment != 'S':
+                df[compartment] = trajectory[:, index]
 
-        data = {'fact_infected': list(extended_actual[:self.predict_range]),
-                'fact_recovered': list(extended_recovered[:self.predict_range]), 'predicted_infected': list(I),
-                'predicted_recovered': list(R), 'params': {'beta': beta, 'gamma': gamma}}
+        data = {f'fact_{name}': extended[name][:self.predict_range] for name in model.series}
+        data.update({f'predicted_{name}': np.asarray(observed[name], dtype=float) for name in model.series})
+        data.update({'params': dict(zip(model.parameters, params)), 'cache_key': key, 'fit': fit})
+        if self.beta:
+            size = len(trajectory)
+            data['beta'] = dict(self.beta, daily=np.array([model.rhs.schedule(day, params) for day in range(size)],
+                                                          dtype=float))
+        if bands is not None:
+            data['bootstrap'] = {'samples': self.bootstrap, 'percentiles': PERCENTILES,
+                                 'params': {name: list(param_bands[:, index])
+                                            for index, name in enumerate(model.parameters)}}
+            data['bootstrap'].update({f'predicted_{name}': np.asarray(band, dtype=float)
+                                      for name, band in bands.items()})
 
         fig, ax = plt.subplots(figsize=(15, 10))
         ax.set_title(self.country)
         df.plot(ax=ax)
-        print(f"country={self.country}, beta={beta:.8f}, gamma={gamma:.8f}, r_0:{(beta / gamma):.8f}")
+        if bands is not None:
+            for name, band in bands.items():
+                ax.fill_between(range(len(df)), band[0], band[-1], alpha=0.2,
+                                label=f'{name.capitalize()} {PERCENTILES[0]}-{PERCENTILES[-1]}%')
+            ax.legend()
+        message = f"country={self.country}, {self.describe(params)}"
+        if model.reproduction_number:
+            message += f", r_0:{model.reproduction_number(*params):.8f}"
+        print(message)
 
-        folder_path = f'SIR/{self.country}/'
         os.makedirs(folder_path, exist_ok=True)
-        with open(folder_path + f'data.json', 'w') as outfile:
-            json.dump(data, outfile, indent=4)
-        fig.savefig(folder_path + f"{self.country}.png")
+        save_artifact(folder_path, data, binary=self.artifact == 'npy')
+        fig.savefig(folder_path + f"{self.country}.png.tmp", format='png')
+        os.replace(folder_path + f"{self.country}.png.tmp", folder_path + f"{self.country}.png")
+        plt.close(fig)
+
+
+def series_error(observed, actual):
+    """
+    RMSE-like error, days go along the first axis of observed, parameter sets along the second if any.
+    actual is one series (days) or a series per parameter set (days, sets)
+    """
+    if np.ndim(observed) > np.ndim(actual):
+        actual = actual[:, None]
+    return np.sqrt(np.mean((observed - actual) ** 2, axis=0) / len(observed))
 
 
-def loss(point, infected, recovered, s_0, i_0, r_0):
+def sir_error(I, R, infected, recovered, alpha=ALPHA):
+    """Weighted RMSE-like loss, days go along the first axis of I and R, parameter sets along the second if any"""
+    return alpha * series_error(I, infected) + (1 - alpha) * series_error(R, recovered)
+
+
+def loss(point, infected, recovered, s_0, i_0, r_0, engine='odeint'):
     size = len(infected)
     beta, gamma = point
 
-    S, I, R = odeint(SIR, [s_0, i_0, r_0], range(0, size), args=(s_0, beta, gamma)).T
-    l1 = np.sqrt(np.mean((I - infected) ** 2) / len(I))
-    l2 = np.sqrt(np.mean((R - recovered) ** 2) / len(R))
-    alpha = 0.8
-    return alpha * l1 + (1 - alpha) * l2
+    S, I, R = integrate([s_0, i_0, r_0], size, (s_0, beta, gamma), engine).T
+    return sir_error(I, R, infected, recovered)
+
+
+def loss_and_gradient(point, infected, recovered, s_0, i_0, r_0, engine='odeint', alpha=ALPHA):
+    """
+    Loss and its exact gradient by (beta, gamma) from one integration of SIR with sensitivities:
+    d l1 / d beta = sum((I - infected) * I_b) / (n^2 * l1), the same for l2, R and gamma
+    """
+    size = len(infected)
+    beta, gamma = point
+
+    S, I, R, S_b, I_b, R_b, S_g, I_g, R_g = integrate([s_0, i_0, r_0] + [0] * 6, size, (s_0, beta, gamma),
+                                                      engine, SIR_sensitivity).T
+    error_i, error_r = I - infected, R - recovered
+    l1 = np.sqrt(np.mean(error_i ** 2) / size)
+    l2 = np.sqrt(np.mean(error_r ** 2) / size)
+
+    gradient = np.zeros(2)
+    if l1 > 0:
+        gradient += alpha * np.array([error_i @ I_b, error_i @ I_g]) / (size ** 2 * l1)
+    if l2 > 0:
+        gradient += (1 - alpha) * np.array([error_r @ R_b, error_r @ R_g]) / (size ** 2 * l2)
+    return alpha * l1 + (1 - alpha) * l2, gradient
+
+
+def batch_loss(points, infected, recovered, s_0, i_0, r_0):
+    """Losses of k (beta, gamma) pairs given as array (2, k), computed with one vectorized rk4 integration"""
+    beta, gamma = np.asarray(points, dtype=float)
+    S, I, R = rk4(SIR, [s_0, i_0, r_0], len(infected), (s_0, beta, gamma)).transpose(1, 0, 2)
+    return sir_error(I, R, infected, recovered)
+
+
+def sir_gradient(point, data, s_0, i_0, r_0, engine='odeint'):
+    return loss_and_gradient(point, data['infected'], data['recovered'], s_0, i_0, r_0, engine)
+
+
+def model_loss(point, model, data, s_0, i_0, r_0, engine='odeint'):
+    trajectory = integrate(model.initial_state(s_0, i_0, r_0), len(data['infected']), (s_0, *point), engine,
+                           model.rhs)
+    return model.error(trajectory, data)
+
+
+def model_batch_loss(points, model, data, s_0, i_0, r_0):
+    """Losses of k parameter sets given as array (parameters, k), computed with one vectorized rk4 integration"""
+    trajectory = rk4(model.rhs, model.initial_state(s_0, i_0, r_0), len(data['infected']),
+                     (s_0, *np.asarray(points, dtype=float)))
+    return model.error(trajectory, data)
+
+
+def model_loss_and_gradient(point, model, data, s_0, i_0, r_0, engine='odeint', step=1e-7):
+    """
+    Loss and gradient by the parameters: analytic if the model has it, otherwise central differences.
+    With rk4 the point and its 2 * parameters shifts are integrated at once, with odeint one by one
+    """
+    if model.gradient:
+        return model.gradient(point, data, s_0, i_0, r_0, engine)
+
+    point = np.asarray(point, dtype=float)
+    shifts = step * np.eye(len(point))
+    points = np.column_stack([point, *(point + shifts), *(point - shifts)])
+    if engine == 'rk4':
+        losses = model_batch_loss(points, model, data, s_0, i_0, r_0)
+    else:
+        losses = np.array([model_loss(column, model, data, s_0, i_0, r_0, engine) for column in points.T])
+    forward, backward = losses[1:len(point) + 1], losses[len(point) + 1:]
+    return losses[0], (forward - backward) / (2 * step)
+
+
+def batch_levenberg_marquardt(points, model, data, s_0, i_0, r_0, iterations=200, step=1e-7, tolerance=1e-9,
+                              max_damping=1e8):
+    """
+    Minimizes the loss of k parameter sets (parameters, k), each against its own series (days, k) of data,
+    by Levenberg-Marquardt steps on all sets at once: Jacobians of the series are forward differences
+    from one rk4 integration of the sets and their shifts, the Hessian of the weighted sum of square roots
+    of squared errors is taken without second derivatives of the series (Gauss-Newton). With large residuals
+    these steps are too short, so the step times each of STEP_SCALES is tried in the same integration.
+    Parameters on a bound which the gradient pushes out and parameters the series do not depend on are kept,
+    other steps are clipped to the model bounds. A step which does not decrease the local model after clipping
+    (it overshoots to the bounds) is not tried and its set is retried with more damping, i.e. a shorter step
+    closer to the gradient. A set leaves the batch when an accepted step decreased its loss by less than
+    tolerance relative to the loss or when even steps damped over max_damping do not decrease it,
+    so late iterations integrate only slow sets.
+    Returns the parameter sets and the number of iterations
+    """
+    points = np.array(points, dtype=float)
+    n, k = points.shape
+    state, days = model.initial_state(s_0, i_0, r_0), len(data['infected'])
+    low, high = np.array(model.bounds).T[:, :, None]
+    damping = np.full(k, 1e-3)
+    active = np.arange(k)
+    for iteration in range(1, iterations + 1):
+        sets, series, m = points[:, active], {name: values[:, active] for name, values in data.items()}, len(active)
+        batch = np.concatenate([sets] + [sets + step * row[:, None] for row in np.eye(n)], axis=1)
+        observed = model.observables(rk4(model.rhs, state, days, (s_0, *batch)))
+
+        current, gradient, hessian = np.zeros(m), np.zeros((m, n)), np.zeros((m, n, n))
+        for name, weight in model.weights.items():
+            values = observed[name].reshape(days, n + 1, m)
+            error = values[:, 0] - series[name]
+            jacobian = (values[:, 1:] - values[:, :1]) / step
+            root = np.sqrt(np.sum(error ** 2, axis=0))
+            scale = weight / (days * np.maximum(root, 1e-300))
+            projection = np.einsum('dk,dpk->kp', error, jacobian)
+            current += weight * root / days
+            gradient += scale[:, None] * projection
+            hessian += scale[:, None, None] * (np.einsum('dpk,dqk->kpq', jacobian, jacobian) -
+                                               projection[:, :, None] * projection[:, None, :] /
+                                               np.maximum(root, 1e-300)[:, None, None] ** 2)
+
+        bound = ((sets <= low) & (gradient.T > 0)) | ((sets >= high) & (gradient.T < 0))
+        # a parameter the series do not depend on (e.g. beta of a window without cases) has a zero row
+        insensitive = np.einsum('kpp->kp', hessian) <= 0
+        free = ~bound.T & ~insensitive
+        gradient = np.where(free, gradient, 0)
+        hessian = np.where(free[:, :, None] & free[:, None, :], hessian, np.eye(n))
+        diagonal = np.maximum(np.einsum('kpp->kp', hessian), 1e-12 * np.max(np.abs(hessian), axis=(1, 2))[:, None])
+        delta = np.linalg.solve(hessian + damping[active, None, None] * diagonal[:, :, None] * np.eye(n),
+                                -gradient[:, :, None])[:, :, 0]
+        candidate = np.clip(sets + delta.T, low, high)
+        descent = -np.einsum('kp,pk->k', gradient, candidate - sets) > 0
+        damping[active[~descent]] *= 4
+        retried = active[~descent]
+        active, sets, candidate, current = active[descent], sets[:, descent], candidate[:, descent], current[descent]
+        if not len(active):
+            active = retried[damping[retried] <= max_damping]
+            if not len(active):
+                break
+            continue
+
+        shifts = np.concatenate([factor * (candidate - sets) for factor in STEP_SCALES], axis=1)
+        steps = np.clip(np.tile(sets, len(STEP_SCALES)) + shifts, low, high)
+        with np.errstate(over='ignore', invalid='ignore'):
+            losses = model.error(rk4(model.rhs, state, days, (s_0, *steps)),
+                                 {name: np.tile(values[:, active], len(STEP_SCALES))
+                                  for name, values in data.items()})
+        losses = np.where(np.isfinite(losses), losses, np.inf).reshape(len(STEP_SCALES), -1)
+        best = np.argmin(losses, axis=0)
+        losses = losses[best, np.arange(len(active))]
+        accepted = losses < current
+        candidate = steps.reshape(n, len(STEP_SCALES), -1)[:, best, np.arange(len(active))]
+        points[:, active] = np.where(accepted, candidate, sets)
+        damping[active] = np.where(accepted, damping[active] / 3, damping[active] * 4)
+        active = np.concatenate([retried, active[~accepted | (current - losses > tolerance * current)]])
+        active = np.sort(active[damping[active] <= max_damping])
+        if not len(active):
+            break
+    return points, iteration
+
+
+def bootstrap(model, params, data, s_0, i_0, r_0, samples, size, seed=0):
+    """
+    Residual bootstrap: samples series made of the fitted curves plus residuals of random days (the same days
+    for all series of a sample) are refitted together by batch_levenberg_marquardt started at params.
+    Returns parameter sets (parameters, samples), their forecasts over size days {series: (size, samples)}
+    and the number of iterations
+    """
+    state, days = model.initial_state(s_0, i_0, r_0), len(data['infected'])
+    fitted = model.observables(rk4(model.rhs, state, days, (s_0, *params)))
+    resampled_days = np.random.default_rng(seed).integers(days, size=(days, samples))
+    resampled = {name: fitted[name][:, None] + (values - fitted[name])[resampled_days]
+                 for name, values in data.items()}
+
+    start = np.repeat(np.asarray(params, dtype=float)[:, None], samples, axis=1)
+    ensemble, iterations = batch_levenberg_marquardt(start, model, resampled, s_0, i_0, r_0)
+    forecast = model.observables(rk4(model.rhs, state, size, (s_0, *ensemble)))
+    return ensemble, forecast, iterations
+
+
+MODELS = {
+    'SIR': Model('SIR', SIR, ['S', 'I', 'R'], ['beta', 'gamma'], BOUNDS, INITIAL_GUESS, gradient=sir_gradient,
+                 reproduction_number=lambda beta, gamma: beta / gamma),
+    'SIRD': Model('SIRD', SIRD, ['S', 'I', 'R', 'D'], ['beta', 'gamma', 'mu'],
+                  [(0.00000001, 0.4), (0.00000001, 0.4), (0.00000001, 0.1)], [0.4, 0.05, 0.005],
+                  reproduction_number=lambda beta, gamma, mu: beta / (gamma + mu)),
+    'SEIR': Model('SEIR', SEIR, ['S', 'E', 'I', 'R'], ['beta', 'sigma', 'gamma'],
+                  [(0.00000001, 1), (0.05, 1), (0.00000001, 0.4)], [0.5, 0.2, 0.05],
+                  reproduction_number=lambda beta, sigma, gamma: beta / gamma),
+}
+
+
+def grid_search(model, data, s_0, i_0, r_0, size=GRID_SIZE, levels=GRID_LEVELS):
+    """
+    Losses over log-spaced grids of the model parameters, each level is one batched rk4 integration.
+    Every axis has size values for two parameters and fewer for more, so a level has about size^2 points.
+    The first level covers the bounds (from 1e-4), every next one the cells around the best point of the previous.
+    Returns [(axes, losses)] of all levels, losses[i, j, ...] belongs to axes[0][i], axes[1][j], ...,
+    diverged points have infinite loss
+    """
+    size = max(2, int(round(size ** (2 / len(model.parameters)))))
+    limits = [(max(low, 1e-4), high) for low, high in model.bounds]
+    surfaces = []
+    for level in range(levels):
+        axes = [np.geomspace(low, high, size) for low, high in limits]
+        points = np.array(np.meshgrid(*axes, indexing='ij')).reshape(len(axes), -1)
+        with np.errstate(over='ignore', invalid='ignore'):
+            losses = model_batch_loss(points, model, data, s_0, i_0, r_0).reshape([size] * len(axes))
+        losses[~np.isfinite(losses)] = np.inf
+        surfaces.append((axes, losses))
+
+        best = np.unravel_index(np.argmin(losses), losses.shape)
+        limits = [(axis[max(index - 1, 0)], axis[min(index + 1, size - 1)]) for axis, index in zip(axes, best)]
+    return surfaces
+
+
+def best_cells(surfaces, count=GRID_STARTS):
+    """Parameters of the count lowest losses over all grid levels"""
+    points = np.concatenate([np.array(np.meshgrid(*axes, indexing='ij')).reshape(len(axes), -1)
+                             for axes, losses in surfaces], axis=1)
+    losses = np.concatenate([losses.ravel() for axes, losses in surfaces])
+    return [list(points[:, index]) for index in np.argsort(losses, kind='stable')[:count]]
+
+
+def save_loss_surface(folder_path, model, surfaces):
+    """
+    Axes <parameter>_<level> (beta_0, gamma_0, ...) and loss_<level> arrays of grid_search
+    in folder_path/loss_surface.npz
+    """
+    arrays = {}
+    for level, (axes, losses) in enumerate(surfaces):
+        arrays.update({f'{name}_{level}': axis for name, axis in zip(model.parameters, axes)})
+        arrays[f'loss_{level}'] = losses
+    os.makedirs(folder_path, exist_ok=True)
+    with open(folder_path + 'loss_surface.npz.tmp', 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    os.replace(folder_path + 'loss_surface.npz.tmp', folder_path + 'loss_surface.npz')
+
+
+def fit_country(country, file_path, predict_range, learner_options):
+    """Trains Learner of one country, returns (country, error message or None, seconds) instead of exiting"""
+    start = timer()
+    try:
+        Learner(country, file_path, loss, predict_range, **learner_options).train()
+        return country, None, timer() - start
+    except SystemExit as error:
+        return country, str(error), timer() - start
+    except Exception as error:
+        return country, f"{error.__class__.__name__}: {error}", timer() - start
+
+
+def use_agg_backend():
+    plt.switch_backend('Agg')
+
+
+def fit_countries(countries, file_path, predict_range, workers, learner_options):
+    """Fits countries one by one or in a pool of `workers` processes, one failed country does not stop others"""
+    countries = list(dict.fromkeys(countries))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_agg_backend) as executor:
+            futures = [executor.submit(fit_country, country, file_path, predict_range, learner_options)
+                       for country in countries]
+            for done, future in enumerate(as_completed(futures), 1):
+                yield done, len(countries), future.result()
+    else:
+        for done, country in enumerate(countries, 1):
+            yield done, len(countries), fit_country(country, file_path, predict_range, learner_options)
 
 
 def main():
-    countries, file_path, predict_range = parse_arguments()
+    countries, file_path, predict_range, workers, learner_options = parse_arguments()
+
+    start = timer()
+    results = []
+    for done, total, (country, error, seconds) in fit_countries(countries, file_path, predict_range, workers,
+                                                               learner_options):
+        results.append((country, error, seconds))
+        print(f"[{done}/{total}] {country}: {'failed -- ' + error if error else 'done'} in {seconds:.2f}s")
 
-    for country in countries:
-        learner = Learner(country, file_path, loss, predict_range)
-        learner.train()
+    print(f"\n{'country':<30}{'seconds':>10}  result")
+    for country, error, seconds in sorted(results, key=lambda result: -result[2]):
+        print(f"{country:<30}{seconds:>10.2f}  {error or 'ok'}")
+    failed = sum(error is not None for country, error, seconds in results)
+    print(f"fitted: {len(results) - failed}, failed: {failed}, total time of fits: "
+          f"{sum(seconds for country, error, seconds in results):.2f}s, wall time: {timer() - start:.2f}s")
 
 
 if __name__ == '__main__':
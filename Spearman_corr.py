@@ -1,13 +1,18 @@
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from datetime import timedelta, datetime
-from scipy.stats import spearmanr
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.stats import t as student, rankdata
+from data_store import load_columns, stringency_files, stringency_series, STRINGENCY_PATH
+from timeit import default_timer as timer
 import argparse
 import sys
 import os
 import json
-from numpy import inf
+
+
+LAG = 14
+ROLLING_STEP = 7
+SERIES = {'infected': ('daily_cases', 'Infection'), 'death': ('death_per_day', 'Death')}
 
 
 def parse_arguments():
@@ -17,8 +22,8 @@ def parse_arguments():
         '--countries',
         action='store',
         dest='countries',
-        help='Name of country/countries separated by comma without spaces' +
-             'It must exact match the data names or you will get out of bonds error.',
+        help='Name of country/countries separated by comma without spaces. '
+             'Defaults to all countries with both covid and stringency files',
         metavar='COUNTRY_NAMES',
         type=str,
         default="")
@@ -32,110 +37,417 @@ def parse_arguments():
         type=str,
         default="Data/Covid")
 
+    parser.add_argument(
+        '--lag',
+        required=False,
+        dest='lag',
+        help=f'Days between a covid day and the stringency day it is compared with. Default is {LAG}',
+        metavar='LAG',
+        type=int,
+        default=LAG)
+
+    parser.add_argument(
+        '--lag-range',
+        required=False,
+        dest='lag_range',
+        help='Compute rho and p-value for every lag from START to END days inclusive (e.g. 0:60) '
+             'and report the lag with the strongest correlation instead of a single lag',
+        metavar='START:END',
+        type=str,
+        default="")
+
+    parser.add_argument(
+        '--window',
+        required=False,
+        dest='window',
+        help='Compute rho and p-value in rolling windows of WINDOW days (e.g. 30) instead of the whole period',
+        metavar='WINDOW',
+        type=int,
+        default=0)
+
+    parser.add_argument(
+        '--step',
+        required=False,
+        dest='step',
+        help=f'Days between starts of rolling windows. Default is {ROLLING_STEP}',
+        metavar='STEP',
+        type=int,
+        default=ROLLING_STEP)
+
+    parser.add_argument(
+        '--cross-country',
+        action='store_true',
+        dest='cross_country',
+        help='Correlate the lagged stringency index of every country with case growth of every country')
+
     args = parser.parse_args()
 
     try:
         countries_raw = args.countries
-        country_list = countries_raw.split(",")
+        country_list = countries_raw.split(",") if countries_raw else all_countries(args.file_path)
     except Exception:
         sys.exit("QUIT: countries parameter are not in correct format")
 
-    return country_list, args.file_path
+    if args.window < 0 or args.step < 1:
+        sys.exit("QUIT: window must not be negative and step must be positive")
+    if args.window and args.lag_range:
+        sys.exit("QUIT: use either window or lag-range")
+    if args.cross_country and (args.window or args.lag_range or args.countries):
+        sys.exit("QUIT: cross-country uses all countries and a single lag")
+
+    lags = None
+    if args.lag_range:
+        try:
+            start, end = (int(value) for value in args.lag_range.split(":"))
+        except ValueError:
+            sys.exit("QUIT: lag-range parameter must be START:END, e.g. 0:60")
+        if end < start:
+            sys.exit("QUIT: lag-range END must not be less than START")
+        lags = np.arange(start, end + 1)
+
+    return country_list, args.file_path, args.lag, lags, args.window, args.step, args.cross_country
+
+
+def all_countries(file_path, stringency_path=STRINGENCY_PATH):
+    """Countries of stringency files which also have a covid file"""
+    return [name for name in stringency_files(stringency_path) if os.path.exists(f'{file_path}{name.capitalize()}.csv')]
+
+
+def covid_countries(file_path):
+    """Countries of all files named {file_path}{Country}.csv"""
+    folder, prefix = os.path.split(file_path)
+    return sorted(name[len(prefix):-len('.csv')] for name in os.listdir(folder)
+                  if name.startswith(prefix) and name.endswith('.csv'))
+
+
+def day_numbers(dates):
+    """Days since 1970-01-01 of date strings or datetime64 values"""
+    return np.asarray(dates).astype('datetime64[D]').astype(np.int64)
+
+
+def growth(values):
+    """Daily relative change like pandas pct_change, 0 for the first day and 0/0, 1 for x/0 with x > 0"""
+    values = np.asarray(values, dtype=float)
+    change = np.zeros(len(values))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change[1:] = values[1:] / values[:-1] - 1
+    change[np.isnan(change)] = 0
+    change[change == np.inf] = 1
+    return change
+
+
+def masked_ranks(values, valid):
+    """
+    Average ranks (as scipy.stats.rankdata) of values among the entries selected by every row of the boolean
+    mask valid (rows x len(values)). Values are compared with each other once and all rows reuse the comparisons
+    """
+    values = np.asarray(values, dtype=float)
+    less = (values[None, :] < values[:, None]).astype(float)
+    equal = (values[None, :] == values[:, None]).astype(float)
+    valid = valid.astype(float)
+    return valid @ less.T + (valid @ equal.T + 1) / 2
+
+
+def masked_spearman(x_ranks, y_ranks, valid):
+    """Spearman's rho and two-sided p-value for every row from the ranks of its valid entries"""
+    size = valid.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(valid, x_ranks - np.sum(np.where(valid, x_ranks, 0), axis=1, keepdims=True) / size[:, None], 0)
+        y = np.where(valid, y_ranks - np.sum(np.where(valid, y_ranks, 0), axis=1, keepdims=True) / size[:, None], 0)
+        rho = np.sum(x * y, axis=1) / np.sqrt(np.sum(x * x, axis=1) * np.sum(y * y, axis=1))
+    return spearman_p_value(rho, size)
+
+
+def spearman_p_value(rho, size):
+    """rho clipped to [-1, 1] and its two-sided p-value for size pairs as in scipy.stats.spearmanr, NaN for size < 3"""
+    rho = np.clip(rho, -1, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dof = size - 2
+        statistic = rho * np.sqrt(dof / ((rho + 1) * (1 - rho)))
+        p_value = 2 * student.sf(np.abs(statistic), dof)
+    rho[size < 3] = np.nan
+    p_value[size < 3] = np.nan
+    return rho, p_value
+
+
+def lagged_values(days, index_days, index, lags):
+    """
+    index[day + lag] for every lag (rows) and every day of days (columns) on the integer day axis,
+    NaN where the index has no value for that day
+    """
+    first = index_days[0]
+    dense = np.full(index_days[-1] - first + 1, np.nan)
+    dense[index_days - first] = index
+    positions = days[None, :] + np.asarray(lags)[:, None] - first
+    inside = (positions >= 0) & (positions < len(dense))
+    positions = np.where(inside, positions, 0)
+    return np.where(inside, dense[positions], np.nan), positions, dense
+
+
+def lagged_spearman(days, values, index_days, index, lags):
+    """
+    Spearman's rho and p-value of values[t] against index[t + lag] for every lag, days without an index value
+    are left out as with nan_policy='omit'. Both series are ranked once on their own day axes
+    """
+    lagged, positions, dense = lagged_values(days, index_days, index, lags)
+    valid = ~np.isnan(lagged) & ~np.isnan(values)[None, :]
+
+    rows = np.broadcast_to(np.arange(len(lags))[:, None], valid.shape)
+    dense_valid = np.zeros((len(lags), len(dense)), dtype=bool)
+    dense_valid[rows[valid], positions[valid]] = True
+
+    value_ranks = masked_ranks(values, valid)
+    index_ranks = np.take_along_axis(masked_ranks(dense, dense_valid), positions, axis=1)
+    return masked_spearman(value_ranks, index_ranks, valid)
+
+
+def window_ranks(windows, valid):
+    """Average ranks within every row of windows (windows x days) among its valid entries"""
+    less = (windows[:, None, :] < windows[:, :, None]) & valid[:, None, :]
+    equal = (windows[:, None, :] == windows[:, :, None]) & valid[:, None, :]
+    return less.sum(axis=2) + (equal.sum(axis=2) + 1) / 2
+
+
+def rolling_spearman(days, values, index_days, index, lag, window, step):
+    """
+    Spearman's rho and p-value of values[t] against index[t + lag] in windows of window calendar days
+    starting every step days. Series are put on a dense day axis and cut into strided views,
+    all windows are ranked at once. Returns first days of the windows, rho and p-value
+    """
+    dense = np.full(days[-1] - days[0] + 1, np.nan)
+    dense[days - days[0]] = values
+    all_days = np.arange(days[0], days[-1] + 1)
+    lagged = lagged_values(all_days, index_days, index, [lag])[0][0]
+    if len(all_days) < window:
+        return all_days[:0], np.zeros(0), np.zeros(0)
+
+    value_windows = sliding_window_view(dense, window)[::step]
+    index_windows = sliding_window_view(lagged, window)[::step]
+    valid = ~np.isnan(value_windows) & ~np.isnan(index_windows)
+    rho, p_value = masked_spearman(window_ranks(value_windows, valid), window_ranks(index_windows, valid), valid)
+    return all_days[:len(all_days) - window + 1:step], rho, p_value
+
+
+def day_table(series, first, size):
+    """Rows of (day numbers, values) pairs on the axis of size days from day number first, NaN on other days"""
+    table = np.full((len(series), size), np.nan)
+    for row, (days, values) in enumerate(series):
+        table[row, days - first] = values
+    return table
+
+
+def cross_spearman(x, y):
+    """
+    Spearman's rho, p-value and number of common days of every row of x against every row of y, NaN marks missing
+    days. Every row is ranked once among its own days and rho of a pair is the Pearson correlation of these ranks
+    over the days both rows have, computed for all pairs at once from matrix products of ranks and masks
+    """
+    x_mask, y_mask = (~np.isnan(x)).astype(float), (~np.isnan(y)).astype(float)
+    x_ranks = np.nan_to_num(rankdata(x, axis=1, nan_policy='omit'))
+    y_ranks = np.nan_to_num(rankdata(y, axis=1, nan_policy='omit'))
+
+    size = x_mask @ y_mask.T
+    x_sum, y_sum = x_ranks @ y_mask.T, x_mask @ y_ranks.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = x_ranks @ y_ranks.T - x_sum * y_sum / size
+        x_variance = (x_ranks * x_ranks) @ y_mask.T - x_sum * x_sum / size
+        y_variance = x_mask @ (y_ranks * y_ranks).T - y_sum * y_sum / size
+        rho = covariance / np.sqrt(x_variance * y_variance)
+    rho, p_value = spearman_p_value(rho, size)
+    return rho, p_value, size.astype(np.int32)
+
+
+def best_lag(lags, rho):
+    """Lag with the largest absolute rho or None if rho is not defined for any lag"""
+    if np.all(np.isnan(rho)):
+        return None
+    return int(lags[np.nanargmax(np.abs(rho))])
 
 
 class Spearman(object):
-    def __init__(self, country, file_path):
+    def __init__(self, country, file_path, lag=LAG, lags=None, window=0, step=ROLLING_STEP):
         self.country = country
         self.file_path = file_path
+        self.lag = lag
+        self.lags = lags
+        self.window = window
+        self.step = step
 
     def train(self):
         """ Retrieve Covid Data """
-        file_name = str(self.file_path).capitalize()
+        file_name = self.file_path if str(self.file_path).endswith('.csv') else \
+            f'{self.file_path}{str(self.country).capitalize()}.csv'
         try:
-            covid_country_info = pd.read_csv(file_name)
-        except:
+            covid_country_info = load_columns(file_name)
+        except OSError:
             sys.exit("There is no file {} -- train func // country".format(file_name))
 
-        death = covid_country_info['death_per_day'].values
-        infected = covid_country_info['daily_cases'].values
-        covid_date = covid_country_info['time'].values
+        covid_days = day_numbers(covid_country_info['time'])
+        series = {name: growth(covid_country_info[column])
+                  for name, (column, key) in SERIES.items() if column in covid_country_info}
 
         """ Retrieve Restrictions Data """
-        restr_file = "all_restrictions/Stringency{}.csv".format(str(self.country).capitalize())
         try:
-            stringency_country_info = pd.read_csv(restr_file)
-        except:
-            print("There is no file {} -- train func // all_restrictions".format(file_name))
+            stringency_dates, index = stringency_series(self.country)
+        except OSError:
+            print("There is no file {}{}.csv -- train func // all_restrictions".format(
+                STRINGENCY_PATH, str(self.country).capitalize()))
+            return
+
+        stringency_days = day_numbers(stringency_dates)
+
+        folder_path = f'Spearman/{self.country}/'
+        os.makedirs(folder_path, exist_ok=True)
+        if self.window:
+            rolling = {name: rolling_spearman(covid_days, values, stringency_days, index,
+                                              self.lag, self.window, self.step)
+                       for name, values in series.items()}
+            self.save_rolling(folder_path, rolling)
             return
-            
-        index = stringency_country_info['Stringency Index (OxBSG)'].values
-
-        """ Time Lag 14 Days """
-        values = []
-        stringency_date = stringency_country_info['Date'].values
-        for i in range(len(stringency_date)):
-            current = datetime.strptime(stringency_country_info.iloc[i]['Date'], '%Y-%m-%d')
-            str_date = np.array([datetime.strftime(current, '%Y-%m-%d')])
-            current = current - timedelta(days=14)
-            values.append(datetime.strftime(current, '%Y-%m-%d'))
-
-        """ Merging Data """
-        df_covid = pd.DataFrame(
-            {'date': covid_date,
-             'infected': infected,
-             'death': death,
-             })
-        df_covid['infected'] = df_covid['infected'].pct_change()
-        df_covid['death'] = df_covid['death'].pct_change()
-        df_covid = df_covid.fillna(0)
-        df_covid = df_covid.replace(np.inf, 1)
-
-        df_stringency = pd.DataFrame(
-            {'date': values,
-             'index': index,
-             })
-
-        df_covid = df_covid.merge(right=df_stringency.reset_index(drop=True), how='left', on='date')
 
         """ Checking Correlation """
-        coef_inf, p_inf = spearmanr(df_covid['infected'].values, df_covid['index'].values, nan_policy='omit')
-        print('INFECTED -- Spearmans correlation coefficient: %.3f' % coef_inf)
-        print('INFECTED -- Spearmans correlation p-value: %.3f' % p_inf)
+        lags = np.array([self.lag]) if self.lags is None else self.lags
+        correlations = {name: lagged_spearman(covid_days, values, stringency_days, index, lags)
+                        for name, values in series.items()}
+
+        if self.lags is None:
+            self.save_lag(folder_path, series, correlations, covid_days, stringency_days, index)
+        else:
+            self.save_lags(folder_path, lags, correlations)
+
+    def save_lag(self, folder_path, series, correlations, covid_days, stringency_days, index):
+        data = {}
+        for name, (rho, p_value) in correlations.items():
+            key = SERIES[name][1]
+            print(f'{name.upper()} -- Spearmans correlation coefficient: %.3f' % rho[0])
+            print(f'{name.upper()} -- Spearmans correlation p-value: %.3f' % p_value[0])
+            data[f'{key}_corr_index'] = rho[0]
+            data[f'{key}_p-value'] = p_value[0]
+        data['lag'] = self.lag
 
-        coef_death, p_death = spearmanr(df_covid['death'].values, df_covid['index'].values, nan_policy='omit')
-        print('DEATH -- Spearmans correlation coefficient: %.3f' %coef_death)
-        print('DEATH -- Spearmans correlation p-value: %.3f' %p_death)
+        lagged = lagged_values(covid_days, stringency_days, index, [self.lag])[0][0]
+        for name, values in series.items():
+            fig, ax = plt.subplots()
+            ax.scatter(values, lagged)
+            ax.set_title(self.country)
+            ax.set_xlabel(name)
+            ax.set_ylabel("stringency index")
+            fig.savefig(folder_path + f"{name}{self.country}.png")
+            plt.close(fig)
 
-        data = {'Infection_corr_index': coef_inf,
-                'Infection_p-value': p_inf,
-                'Death_corr_index': coef_death,
-                'Death_p-value': p_death}
+        with open(folder_path + f'Spearman{self.country}.json', 'w') as outfile:
+            json.dump(data, outfile, indent=4)
+
+    def save_lags(self, folder_path, lags, correlations):
+        data = {'lags': lags.tolist()}
+        fig, (ax_rho, ax_p) = plt.subplots(2, 1, sharex=True)
+        for name, (rho, p_value) in correlations.items():
+            key = SERIES[name][1]
+            lag = best_lag(lags, rho)
+            data[f'{key}_corr_index'] = [None if np.isnan(value) else value for value in rho.tolist()]
+            data[f'{key}_p-value'] = [None if np.isnan(value) else value for value in p_value.tolist()]
+            data[f'{key}_best_lag'] = lag
+            if lag is None:
+                print(f'{name.upper()} -- no lag with a defined Spearmans correlation')
+            else:
+                position = lag - lags[0]
+                print(f'{name.upper()} -- strongest Spearmans correlation %.3f (p-value %.3f) at lag {lag} days'
+                      % (rho[position], p_value[position]))
+            ax_rho.plot(lags, rho, label=name)
+            ax_p.plot(lags, p_value, label=name)
+
+        ax_rho.set_title(self.country)
+        ax_rho.set_ylabel("Spearman's rho")
+        ax_rho.legend(loc='best')
+        ax_p.set_xlabel("lag, days")
+        ax_p.set_ylabel("p-value")
+
+        with open(folder_path + f'lags{self.country}.json', 'w') as outfile:
+            json.dump(data, outfile, indent=4)
+        fig.savefig(folder_path + f"lags{self.country}.png")
+        plt.close(fig)
 
+    def save_rolling(self, folder_path, rolling):
+        data = {'window': self.window, 'step': self.step, 'lag': self.lag}
         fig, ax = plt.subplots()
-        ax.scatter(df_covid['infected'].values, df_covid['index'].values)
-        ax.set_title(self.country)
-        ax.set_xlabel("infected")
-        ax.set_ylabel("stringency index")
+        for name, (starts, rho, p_value) in rolling.items():
+            key = SERIES[name][1]
+            dates = starts.astype('datetime64[D]')
+            data[f'{key}_start'] = np.datetime_as_string(dates, unit='D').tolist()
+            data[f'{key}_corr_index'] = [None if np.isnan(value) else value for value in rho.tolist()]
+            data[f'{key}_p-value'] = [None if np.isnan(value) else value for value in p_value.tolist()]
+            ax.plot(dates + self.window // 2, rho, label=name)
+        print(f'{self.country} -- Spearmans correlation in {len(data["Infection_start"])} windows of {self.window} days')
 
-        fig_d, ax_d = plt.subplots()
-        ax_d.scatter(df_covid['death'].values, df_covid['index'].values)
-        ax_d.set_title(self.country)
-        ax_d.set_xlabel("death")
-        ax_d.set_ylabel("stringency index")
+        ax.axhline(0, color='grey', linewidth=0.5)
+        ax.set_title(f'{self.country}, {self.window} days windows')
+        ax.set_xlabel("window center")
+        ax.set_ylabel("Spearman's rho")
+        ax.legend(loc='best')
+        fig.autofmt_xdate()
 
-        folder_path = f'Spearman/{self.country}/'
-        os.makedirs(folder_path, exist_ok=True)
-        with open(folder_path + f'Spearman{self.country}.json', 'w') as outfile:
+        with open(folder_path + f'rolling{self.country}.json', 'w') as outfile:
             json.dump(data, outfile, indent=4)
-        fig.savefig(folder_path + f"infected{self.country}.png")
-        fig_d.savefig(folder_path + f"death{self.country}.png")
+        fig.savefig(folder_path + f"rolling{self.country}.png")
+        plt.close(fig)
+
+
+class CrossCountry(object):
+    """Spearman's rho of the stringency index of every country lag days later against case growth of every country"""
+    def __init__(self, file_path, lag=LAG):
+        self.file_path = file_path
+        self.lag = lag
+
+    def train(self):
+        start = timer()
+        stringency = {}
+        for country in stringency_files():
+            days, values = stringency_series(country)
+            stringency[country] = (day_numbers(days), np.asarray(values))
+        growths = {}
+        for country in covid_countries(self.file_path):
+            covid_country_info = load_columns(f'{self.file_path}{country}.csv')
+            growths[country] = (day_numbers(covid_country_info['time']), growth(covid_country_info['daily_cases']))
+
+        """ Stringency of day t + lag is put on day t """
+        series = [(days - self.lag, values) for days, values in stringency.values()] + list(growths.values())
+        first = min(days.min() for days, values in series if len(days))
+        size = max(days.max() for days, values in series if len(days)) - first + 1
+        lagged = day_table(series[:len(stringency)], first, size)
+        cases = day_table(series[len(stringency):], first, size)
+
+        rho, p_value, days = cross_spearman(lagged, cases)
+        print(f"{len(stringency)} x {len(growths)} Spearmans correlations at lag {self.lag} days "
+              f"({timer() - start:.2f}s)")
+
+        folder_path = 'Spearman/'
+        os.makedirs(folder_path, exist_ok=True)
+        np.savez(folder_path + f'CrossCountryLag{self.lag}.npz', rho=rho.astype(np.float32),
+                 p_value=p_value.astype(np.float32), days=days, lag=self.lag,
+                 stringency_countries=np.array(list(stringency)), covid_countries=np.array(list(growths)))
+
+        fig, ax = plt.subplots(figsize=(24, 24))
+        image = ax.imshow(rho, cmap='RdBu_r', vmin=-1, vmax=1)
+        ax.set_xticks(np.arange(len(growths)))
+        ax.set_xticklabels(list(growths), rotation=90, fontsize=4)
+        ax.set_yticks(np.arange(len(stringency)))
+        ax.set_yticklabels(list(stringency), fontsize=4)
+        ax.set_xlabel("case growth")
+        ax.set_ylabel(f"stringency index {self.lag} days later")
+        fig.colorbar(image, ax=ax, shrink=0.5, label="Spearman's rho")
+        fig.savefig(folder_path + f'CrossCountryLag{self.lag}.png', dpi=150, bbox_inches='tight')
+        plt.close(fig)
 
 
 def main():
-    countries, file_path = parse_arguments()
+    countries, file_path, lag, lags, window, step, cross_country = parse_arguments()
+
+    if cross_country:
+        CrossCountry(file_path, lag).train()
+        return
 
     for country in countries:
-        spearman_corr = Spearman(country, file_path)
+        spearman_corr = Spearman(country, file_path, lag, lags, window, step)
         spearman_corr.train()
 
 
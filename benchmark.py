@@ -0,0 +1,323 @@
+import numpy as np
+from scipy.optimize import minimize, approx_fprime
+from timeit import default_timer as timer
+from datetime import timedelta, datetime
+import tracemalloc
+import tempfile
+import argparse
+import json
+import sys
+import os
+
+import SIR as sir
+import pearson_test as pearson
+from data_store import load_table, save_artifact, load_artifact, json_values
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    engines = subparsers.add_parser(
+        'sir-engines',
+        help='Speed and accuracy of the rk4 engine of SIR.py against odeint')
+    engines.add_argument(
+        '--countries',
+        action='store',
+        dest='countries',
+        help='Name of country/countries separated by comma without spaces. Defaults to all Data/Covid*.csv files',
+        metavar='COUNTRY_NAMES',
+        type=str,
+        default="")
+    engines.add_argument(
+        '--batch',
+        required=False,
+        dest='batch',
+        help='Number of (beta, gamma) pairs in the batched loss. Defaults to 400',
+        metavar='BATCH',
+        type=int,
+        default=400)
+
+    gradient = subparsers.add_parser(
+        'sir-gradient',
+        help='Fits of SIR.py with analytic gradients against finite differences')
+    gradient.add_argument(
+        '--countries',
+        action='store',
+        dest='countries',
+        help='Name of country/countries separated by comma without spaces. Defaults to all Data/Covid*.csv files',
+        metavar='COUNTRY_NAMES',
+        type=str,
+        default="")
+
+    horizon = subparsers.add_parser(
+        'sir-horizon',
+        help='Time and peak memory of loading, extending and saving SIR.py series for long forecasts')
+    horizon.add_argument(
+        '--countries',
+        action='store',
+        dest='countries',
+        help='Name of country/countries separated by comma without spaces. Defaults to all Data/Covid*.csv files',
+        metavar='COUNTRY_NAMES',
+        type=str,
+        default="")
+    horizon.add_argument(
+        '--prediction-days',
+        required=False,
+        dest='predict_range',
+        help='Days to predict. Defaults to 1000',
+        metavar='PREDICT_RANGE',
+        type=int,
+        default=1000)
+
+    artifacts = subparsers.add_parser(
+        'sir-artifacts',
+        help='Write and read time and size of SIR.py data.json with json lists against arrays.npy')
+    artifacts.add_argument(
+        '--countries',
+        action='store',
+        dest='countries',
+        help='Name of country/countries separated by comma without spaces. Defaults to all Data/Covid*.csv files',
+        metavar='COUNTRY_NAMES',
+        type=str,
+        default="")
+    artifacts.add_argument(
+        '--prediction-days',
+        required=False,
+        dest='predict_range',
+        help='Days to predict. Defaults to 1000',
+        metavar='PREDICT_RANGE',
+        type=int,
+        default=1000)
+
+    return parser.parse_args()
+
+
+def data_countries(countries):
+    if countries:
+        return countries.split(",")
+    return sir.all_countries()
+
+
+def best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        func()
+        times.append(timer() - start)
+    return min(times)
+
+
+def sir_series(country):
+    """Learner of the country and its infected, recovered series or None if there are no data"""
+    try:
+        learner = sir.Learner(country, 'Data/Covid', sir.loss, 140)
+        series = sir.load_series(learner.file_path)
+    except SystemExit:
+        return None
+    return learner, series['infected'], series['recovered']
+
+
+def bench_sir_engines(countries, batch):
+    """
+    For every country: time of one loss, of a batch of losses over a (beta, gamma) grid and of the whole fit
+    with each engine, the largest difference between rk4 and odeint trajectories relative to the peak of I
+    and the difference of fitted parameters
+    """
+    print(f"{'country':<28}{'loss ms':>16}{f'batch {batch} ms':>20}{'fit ms':>18}"
+          f"{'traj err':>11}{'beta diff':>11}{'gamma diff':>11}")
+    side = int(np.sqrt(batch))
+    grid = np.array(np.meshgrid(np.linspace(0.01, 0.4, side), np.linspace(0.01, 0.4, side))).reshape(2, -1)
+    bounds = [(0.00000001, 0.4), (0.00000001, 0.4)]
+    for country in countries:
+        series = sir_series(country)
+        if series is None:
+            print(f"{country:<28}no data")
+            continue
+        learner, infected, recovered = series
+        args = (infected, recovered, learner.s_0, learner.i_0, learner.r_0)
+        state = [learner.s_0, learner.i_0, learner.r_0]
+
+        loss_odeint = best_time(lambda: sir.loss([0.4, 0.05], *args))
+        loss_rk4 = best_time(lambda: sir.loss([0.4, 0.05], *args, engine='rk4'))
+        batch_odeint = best_time(lambda: [sir.loss(point, *args) for point in grid.T], repeat=1)
+        batch_rk4 = best_time(lambda: sir.batch_loss(grid, *args), repeat=1)
+
+        start = timer()
+        fit_odeint = minimize(sir.loss, [0.4, 0.05], args=args, method='L-BFGS-B', bounds=bounds)
+        fit_odeint_time = timer() - start
+        start = timer()
+        fit_rk4 = minimize(sir.loss, [0.4, 0.05], args=args + ('rk4',), method='L-BFGS-B', bounds=bounds)
+        fit_rk4_time = timer() - start
+
+        error = 0
+        for beta, gamma in (fit_odeint.x, (0.4, 0.05), (0.2, 0.1)):
+            reference = sir.integrate(state, len(infected), (learner.s_0, beta, gamma))
+            approximate = sir.integrate(state, len(infected), (learner.s_0, beta, gamma), 'rk4')
+            error = max(error, np.max(np.abs(approximate - reference)) / np.max(reference[:, 1]))
+        beta_diff, gamma_diff = np.abs(fit_rk4.x - fit_odeint.x)
+
+        print(f"{country:<28}{loss_odeint * 1e3:>8.2f}/{loss_rk4 * 1e3:<7.2f}"
+              f"{batch_odeint * 1e3:>10.0f}/{batch_rk4 * 1e3:<9.0f}"
+              f"{fit_odeint_time * 1e3:>9.0f}/{fit_rk4_time * 1e3:<8.0f}"
+              f"{error:>11.1e}{beta_diff:>11.1e}{gamma_diff:>11.1e}")
+    print("times are odeint/rk4")
+
+
+def bench_sir_gradient(countries):
+    """
+    For every country: time and number of loss evaluations of the fit with finite differences and with
+    analytic gradients, the largest relative difference between analytic and finite difference gradients
+    and the difference of the reached losses
+    """
+    print(f"{'country':<28}{'fit ms':>16}{'evaluations':>16}{'grad err':>11}{'loss diff':>12}")
+    bounds = [(0.00000001, 0.4), (0.00000001, 0.4)]
+    for country in countries:
+        series = sir_series(country)
+        if series is None:
+            print(f"{country:<28}no data")
+            continue
+        learner, infected, recovered = series
+        args = (infected, recovered, learner.s_0, learner.i_0, learner.r_0)
+
+        start = timer()
+        fit_fd = minimize(sir.loss, [0.4, 0.05], args=args, method='L-BFGS-B', bounds=bounds)
+        fit_fd_time = timer() - start
+        start = timer()
+        fit = minimize(sir.loss_and_gradient, [0.4, 0.05], jac=True, args=args, method='L-BFGS-B', bounds=bounds)
+        fit_time = timer() - start
+
+        error = 0
+        for point in (np.array([0.4, 0.05]), np.array([0.2, 0.1]), np.array([0.15, 0.005])):
+            analytic = sir.loss_and_gradient(point, *args)[1]
+            numeric = approx_fprime(point, sir.loss, 1e-7, *args)
+            error = max(error, np.max(np.abs(analytic - numeric)) / np.max(np.abs(numeric)))
+
+        print(f"{country:<28}{fit_fd_time * 1e3:>8.0f}/{fit_time * 1e3:<7.0f}"
+              f"{fit_fd.nfev:>8}/{fit.nfev:<7}{error:>11.1e}{fit.fun - fit_fd.fun:>12.1e}")
+    print("values are finite differences/analytic")
+
+
+def measure(func):
+    """Seconds and peak traced memory in bytes of one call"""
+    tracemalloc.start()
+    start = timer()
+    func()
+    seconds = timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def legacy_prediction(file_path, predict_range, predicted):
+    """Series of SIR.py before the shared loader: the csv is read twice, the index grows by np.append day by day
+    and series are padded with None into object arrays"""
+    table = load_table(file_path)
+    infected = table['total_currently_infected'].values
+    recovered = table['total_cases'].values - infected
+
+    data = load_table(file_path)
+    current = datetime.strptime(data.iloc[0]['time'], '%Y-%m-%d')
+    values = np.array([datetime.strftime(current, '%Y-%m-%d')])
+    while len(values) < predict_range:
+        current = current + timedelta(days=1)
+        values = np.append(values, datetime.strftime(current, '%Y-%m-%d'))
+
+    extended_actual = np.concatenate((infected, [None] * (predict_range - len(infected))))
+    extended_recovered = np.concatenate((recovered, [None] * (predict_range - len(recovered))))
+    return json.dumps({'fact_infected': list(extended_actual), 'fact_recovered': list(extended_recovered),
+                       'predicted_infected': list(predicted), 'predicted_recovered': list(predicted)})
+
+
+def shared_prediction(file_path, predict_range, predicted):
+    series = sir.load_series(file_path)
+    new_index = sir.extend_index(series['time'][0], predict_range)
+    extended = {name: sir.pad_nan(series[name], len(new_index)) for name in ('infected', 'recovered')}
+    return json.dumps({'fact_infected': json_values(extended['infected']),
+                       'fact_recovered': json_values(extended['recovered']),
+                       'predicted_infected': predicted.tolist(), 'predicted_recovered': predicted.tolist()})
+
+
+def bench_sir_horizon(countries, predict_range):
+    """
+    For every country: time and peak memory of reading the series, building the date index of predict_range days,
+    padding and serializing data.json lists the old way and with the shared loader of SIR.py
+    (the integration itself is the same in both and is left out)
+    """
+    print(f"{'country':<28}{'ms':>18}{'peak KiB':>20}{'speedup':>10}")
+    predicted = np.linspace(0, 1e5, predict_range)
+    for country in countries:
+        if sir_series(country) is None:
+            print(f"{country:<28}no data")
+            continue
+        file_path = f'Data/Covid{country.capitalize()}.csv'
+        if json.loads(legacy_prediction(file_path, predict_range, predicted)) != \
+                json.loads(shared_prediction(file_path, predict_range, predicted)):
+            print(f"{country:<28}outputs differ")
+        legacy_time, legacy_peak = measure(lambda: legacy_prediction(file_path, predict_range, predicted))
+        shared_time, shared_peak = measure(lambda: shared_prediction(file_path, predict_range, predicted))
+        print(f"{country:<28}{legacy_time * 1e3:>9.1f}/{shared_time * 1e3:<8.1f}"
+              f"{legacy_peak / 1024:>10.0f}/{shared_peak / 1024:<9.0f}{legacy_time / shared_time:>10.1f}")
+    print(f"values are old/shared loader for {predict_range} days")
+
+
+def artifact_data(file_path, predict_range):
+    """Content of data.json written by Learner.train for predict_range days with a stand-in forecast"""
+    series = sir.load_series(file_path)
+    size = max(len(series['time']), predict_range)
+    data = {f'fact_{name}': sir.pad_nan(series[name], size)[:predict_range] for name in ('infected', 'recovered')}
+    data.update({f'predicted_{name}': np.linspace(0, 1e5, size) for name in ('infected', 'recovered')})
+    data['params'] = {'beta': 0.2, 'gamma': 0.05}
+    return data
+
+
+def artifact_size(folder_path):
+    return sum(os.path.getsize(os.path.join(folder_path, name)) for name in os.listdir(folder_path))
+
+
+def bench_sir_artifacts(countries, predict_range):
+    """
+    For every country: time of writing data.json of a predict_range days forecast, time of reading its fact and
+    predicted series back as pearson_test does and the size on disk, with json lists and with arrays.npy
+    """
+    print(f"{'country':<28}{'write ms':>18}{'read ms':>18}{'KiB':>18}")
+    with tempfile.TemporaryDirectory() as folder:
+        for country in countries:
+            if sir_series(country) is None:
+                print(f"{country:<28}no data")
+                continue
+            data = artifact_data(f'Data/Covid{country.capitalize()}.csv', predict_range)
+            results = []
+            for binary in (False, True):
+                folder_path = os.path.join(folder, country, 'npy' if binary else 'json') + os.sep
+                os.makedirs(folder_path, exist_ok=True)
+                write = best_time(lambda: save_artifact(folder_path, data, binary))
+                read = best_time(lambda: pearson.data_curves(load_artifact(folder_path)))
+                curves = pearson.data_curves(load_artifact(folder_path))
+                results.append((write, read, artifact_size(folder_path), curves))
+
+            (json_write, json_read, json_size, json_curves), (npy_write, npy_read, npy_size, npy_curves) = results
+            if any(not np.array_equal(json_curves[name], npy_curves[name], equal_nan=True) for name in json_curves):
+                print(f"{country:<28}outputs differ")
+            print(f"{country:<28}{json_write * 1e3:>9.2f}/{npy_write * 1e3:<8.2f}"
+                  f"{json_read * 1e3:>9.2f}/{npy_read * 1e3:<8.2f}{json_size / 1024:>9.0f}/{npy_size / 1024:<8.0f}")
+    print(f"values are json/npy for {predict_range} days")
+
+
+def main():
+    args = parse_arguments()
+
+    if args.benchmark == 'sir-engines':
+        bench_sir_engines(data_countries(args.countries), args.batch)
+    elif args.benchmark == 'sir-gradient':
+        bench_sir_gradient(data_countries(args.countries))
+    elif args.benchmark == 'sir-horizon':
+        bench_sir_horizon(data_countries(args.countries), args.predict_range)
+    elif args.benchmark == 'sir-artifacts':
+        bench_sir_artifacts(data_countries(args.countries), args.predict_range)
+    else:
+        sys.exit(f"QUIT: unknown benchmark {args.benchmark}")
+
+
+if __name__ == '__main__':
+    main()
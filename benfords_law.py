@@ -1,11 +1,10 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from datetime import timedelta, datetime
-from scipy.integrate import odeint
-from scipy.optimize import minimize
-from population_dict import population_dict
-from scipy.stats import chisquare
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from timeit import default_timer as timer
+from data_store import load_table, data_files, file_tables, json_values, DATA_FOLDER
 import scipy.stats as stats
 import argparse
 import sys
@@ -13,6 +12,11 @@ import os
 import json
 
 
+BENFORD_SERIES = ['daily_cases', 'total_currently_infected', 'death_per_day']
+SIGNIFICANCE = 0.99
+RESULTS_FILE = 'Benfords_law/BenfordsLawResults.csv'
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
@@ -20,48 +24,165 @@ def parse_arguments():
         '--countries',
         action='store',
         dest='countries',
-        help='Name of country/countries separated by comma without spaces' +
-             'It must exact match the data names or you will get out of bonds error.',
+        help='Name of country/countries separated by comma without spaces. ' +
+             'Defaults to every csv of the data folder: countries, USA states and russian regions.',
         metavar='COUNTRY_NAMES',
         type=str,
         default="")
 
     parser.add_argument(
-        '--prediction-days',
+        '--data-folder',
+        required=False,
+        dest='data_folder',
+        help='Folder with csv files. Default is ' + DATA_FOLDER,
+        metavar='DATA_FOLDER',
+        type=str,
+        default=DATA_FOLDER)
+
+    parser.add_argument(
+        '--workers',
         required=False,
-        dest='predict_range',
-        help='Days to predict with the model. Defaults to 150',
-        metavar='PREDICT_RANGE',
+        dest='workers',
+        help='Number of processes reading files and counting digits. Defaults to 1',
+        metavar='WORKERS',
         type=int,
-        default=140)
+        default=1)
+
+    parser.add_argument(
+        '--output',
+        required=False,
+        dest='output',
+        help='Combined results table. Default is ' + RESULTS_FILE,
+        metavar='OUTPUT',
+        type=str,
+        default=RESULTS_FILE)
 
     args = parser.parse_args()
 
     try:
         countries_raw = args.countries
-        country_list = countries_raw.split(",")
+        country_list = countries_raw.split(",") if countries_raw else []
     except Exception:
         sys.exit("QUIT: countries parameter are not in correct format")
 
-    return country_list, args.predict_range
+    return country_list, args.data_folder, args.workers, args.output
+
+
+BENFORD_DISTRIBUTION = np.log10(1 + 1 / np.arange(1, 10))
+
+
+def first_digits(values):
+    """
+    Leading digits of absolute values of an array of any shape, 0 for zeros, values below 1 and NaN.
+    Powers of ten are found with log10 and corrected where it is off by one for exact powers
+    """
+    values = np.abs(np.asarray(values, dtype=float))
+    digits = np.zeros(values.shape, dtype=np.int64)
+    valid = np.isfinite(values) & (values >= 1)
+    numbers = values[valid]
+    exponent = np.floor(np.log10(numbers))
+    exponent += numbers >= 10 ** (exponent + 1)
+    exponent -= numbers < 10 ** exponent
+    digits[valid] = np.floor(numbers / 10 ** exponent)
+    return digits
 
 
 def first_digit(number):
-    while number > 9:
-        number //= 10
-    return number
+    return int(first_digits(number))
+
+
+def pack_series(series):
+    """Series of different lengths as rows of one 2-D array padded with NaN"""
+    packed = np.full((len(series), max((len(values) for values in series), default=0)), np.nan)
+    for row, values in zip(packed, series):
+        row[:len(values)] = values
+    return packed
+
+
+def digit_histograms(series):
+    """
+    Counts of leading digits 1..9: a series gives an array of 9, a 2-D batch (series, days) a matrix (series, 9).
+    Zeros and NaN padding of a batch are not counted
+    """
+    digits = first_digits(series)
+    batch = (digits.reshape(int(np.prod(digits.shape[:-1])), digits.shape[-1]) if digits.ndim
+             else digits.reshape(1, 1))
+    offsets = 10 * np.arange(len(batch))[:, None]
+    counts = np.bincount((batch + offsets).ravel(), minlength=10 * len(batch)).reshape(len(batch), 10)[:, 1:]
+    return counts.reshape(digits.shape[:-1] + (9,)) if digits.ndim else counts[0]
+
+
+def digit_shares(counts):
+    """Histograms of digit_histograms divided by their totals, 0 for empty ones"""
+    total = counts.sum(axis=-1, keepdims=True)
+    return np.divide(counts, total, out=np.zeros(counts.shape), where=total > 0)
+
+
+def digit_distributions(series):
+    """Shares of leading digits 1..9 among nonzero values, shaped as digit_histograms"""
+    return digit_shares(digit_histograms(series))
 
 
 def distribution_of_digits(array):
-    distribution_count = [0] * 10
-    for number in array:
-        distribution_count[first_digit(number)] += 1
-    size = len(array)
-    distribution = []
-    for count in distribution_count:
-        distribution.append(count / size)
-    distribution.pop(0)
-    return distribution
+    return digit_distributions(array)
+
+
+def chi_square(counts, expected=BENFORD_DISTRIBUTION):
+    """Pearson statistics of digit histograms (..., 9) against expected shares, NaN for empty histograms"""
+    counts = np.asarray(counts, dtype=float)
+    total = counts.sum(axis=-1)
+    expected_counts = total[..., None] * expected
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, np.sum((counts - expected_counts) ** 2 / expected_counts, axis=-1), np.nan)
+
+
+def file_histograms(file_path, data_folder=DATA_FOLDER):
+    """(table key, series, digit counts) of every series of BENFORD_SERIES in a csv, counted in one batch"""
+    tables = [(key, [column for column in BENFORD_SERIES if column in df.columns], df)
+              for key, source, df in file_tables(file_path, data_folder)]
+    series = [df[column].to_numpy(dtype=float) for key, columns, df in tables for column in columns]
+    counts = iter(digit_histograms(pack_series(series)))
+    return [(key, column, next(counts)) for key, columns, df in tables for column in columns]
+
+
+def benford_files(data_folder=DATA_FOLDER, countries=()):
+    """All csv of data_folder or Covid<Country>.csv of the countries"""
+    if not countries:
+        return list(data_files(data_folder))
+    return [os.path.join(data_folder, f'Covid{str(country).capitalize()}.csv') for country in countries]
+
+
+def benford_histograms(files, data_folder=DATA_FOLDER, workers=1):
+    """file_histograms of all files, one after another or in a pool of `workers` processes"""
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(file_histograms, files, repeat(data_folder),
+                                        chunksize=max(1, len(files) // (4 * workers))))
+    else:
+        results = [file_histograms(file_path, data_folder) for file_path in files]
+    return [row for rows in results for row in rows]
+
+
+def results_table(rows, significance=SIGNIFICANCE):
+    """
+    One row per series: digit shares, number of nonzero values and the chi-square test of all series at once.
+    A series follows Benford's law (validation) if its statistic is not above the critical value,
+    series without nonzero values have no statistic and no validation
+    """
+    keys, columns, counts = zip(*rows)
+    counts = np.array(counts)
+    statistic = chi_square(counts)
+    critical_value = stats.chi2.ppf(q=significance, df=len(BENFORD_DISTRIBUTION) - 1)
+
+    table = pd.DataFrame({'name': keys, 'series': columns, 'values': counts.sum(axis=1)})
+    shares = digit_shares(counts)
+    for digit in range(1, 10):
+        table[f'digit_{digit}'] = shares[:, digit - 1]
+    table['statistic'] = statistic
+    table['p_value'] = stats.chi2.sf(statistic, df=len(BENFORD_DISTRIBUTION) - 1)
+    table['critical_value'] = critical_value
+    table['validation'] = np.where(np.isnan(statistic), None, statistic <= critical_value)
+    return table
 
 
 class Benfords_law(object):
@@ -71,10 +192,10 @@ class Benfords_law(object):
 
     def train(self):
         try:
-            covid_country_info = pd.read_csv(str(self.file_name).capitalize())
+            covid_country_info = load_table(str(self.file_name))
         except:
             print("File error")
-            sys.exit("There is no file {} -- train func".format(file_name))
+            sys.exit("There is no file {} -- train func".format(self.file_name))
 
         death_per_day = covid_country_info['death_per_day'].values
         total_currently_infected = covid_country_info['total_currently_infected'].values
@@ -86,11 +207,10 @@ class Benfords_law(object):
         labels = []
         for i in range(1, 10):
             labels.append(str(i))
-        benfords_law_distribution = [0.301, 0.176, 0.125, 0.097, 0.079, 0.067, 0.058, 0.051, 0.046]
+        benfords_law_distribution = BENFORD_DISTRIBUTION
 
-        death_distribution = distribution_of_digits(death_per_day)
-        infected_distribution = distribution_of_digits(total_currently_infected)
-        daily_cases_distribution = distribution_of_digits(daily_cases)
+        counts = digit_histograms(pack_series([death_per_day, total_currently_infected, daily_cases]))
+        death_distribution, infected_distribution, daily_cases_distribution = digit_shares(counts)
 
         x = np.arange(len(labels)) 
         width = 0.6
@@ -109,34 +229,26 @@ class Benfords_law(object):
         
         fig.savefig(folder_path + f"{self.country}.png")
 
-        #   Pearson test
-        daily_cases_len = len(daily_cases)
-        total_currently_infected_len = len(total_currently_infected)
-        death_per_day_len = len(death_per_day)
-        
-        daily_cases_inf = chisquare(f_obs=daily_cases_distribution*daily_cases_len,
-                                    f_exp=benfords_law_distribution*daily_cases_len)
-        infected_inf = chisquare(f_obs=infected_distribution*total_currently_infected_len,
-                                    f_exp=benfords_law_distribution*total_currently_infected_len)
-        daily_death_inf = chisquare(f_obs=death_distribution*death_per_day_len,
-                                    f_exp=benfords_law_distribution*death_per_day_len)
+        #   Pearson test over nonzero values, the ones with a leading digit
+        daily_death_statistic, infected_statistic, daily_cases_statistic = chi_square(counts)
 
         df = len(benfords_law_distribution) - 1
-        critical_value = stats.chi2.ppf(q=0.99, df=df)
+        critical_value = stats.chi2.ppf(q=SIGNIFICANCE, df=df)
         print("Critical value: ", critical_value)
 
-        daily_cases_validation = False if daily_cases_inf.statistic > critical_value else True
-        infected_validation = False if infected_inf.statistic > critical_value else True
-        daily_death_validation = False if daily_death_inf.statistic > critical_value else True
+        #   a series without nonzero values has no statistic (NaN, null in json) and no validation
+        daily_cases_validation, infected_validation, daily_death_validation = [
+            None if np.isnan(statistic) else bool(statistic <= critical_value)
+            for statistic in (daily_cases_statistic, infected_statistic, daily_death_statistic)]
 
         fin_data = {
             'critical_value': critical_value,
-            'daily_cases_statistic': daily_cases_inf.statistic,
-            'infected_statistic': infected_inf.statistic,
-            'daily_death_statistic': daily_death_inf.statistic,
-            'daily_cases_validation': infected_validation,
-            'infected_validation': daily_death_validation,
-            'daily_death_validation': daily_cases_validation,
+            'daily_cases_statistic': json_values(daily_cases_statistic),
+            'infected_statistic': json_values(infected_statistic),
+            'daily_death_statistic': json_values(daily_death_statistic),
+            'daily_cases_validation': daily_cases_validation,
+            'infected_validation': infected_validation,
+            'daily_death_validation': daily_death_validation,
             }
 
         os.makedirs(folder_path, exist_ok=True)
@@ -144,13 +256,25 @@ class Benfords_law(object):
             json.dump(fin_data, outfile, indent=4)
         
 
-#   TODO: It does not work for common program - needs to be discussed
-# def main():
-#     countries, predict_range = parse_arguments()
+def main():
+    countries, data_folder, workers, output = parse_arguments()
+
+    start = timer()
+    files = benford_files(data_folder, countries)
+    try:
+        rows = benford_histograms(files, data_folder, workers)
+    except OSError as error:
+        sys.exit(f"QUIT: {error}")
+    if not rows:
+        sys.exit(f"QUIT: there are no series to check in {data_folder}")
+    table = results_table(rows)
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    table.to_csv(output, index=False)
+    print(f"{len(table)} series of {len(files)} files, {int((table['statistic'] > table['critical_value']).sum())} "
+          f"do not follow Benford's law, {int(table['statistic'].isna().sum())} have no nonzero values, "
+          f"results are in {output} ({timer() - start:.2f}s)")
 
-#     for country in countries:
-#         benford = Benfords_law(country)
-#         benford.train()
 
-# if __name__ == '__main__':
-#     main()
+if __name__ == '__main__':
+    main()
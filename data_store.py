@@ -0,0 +1,402 @@
+import pandas as pd
+import numpy as np
+from functools import lru_cache
+from result_cache import content_key
+import argparse
+import json
+import os
+
+
+STORE_FOLDER = 'Store'
+DATA_FOLDER = 'Data'
+STRINGENCY_PATH = 'all_restrictions/Stringency'
+STRINGENCY_COLUMN = 'Stringency Index (OxBSG)'
+ARTIFACT_FILE = 'data.json'
+ARRAYS_FILE = 'arrays.npy'
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '--data-folder',
+        required=False,
+        dest='data_folder',
+        help='Folder with csv files to import. Default is ' + DATA_FOLDER,
+        metavar='DATA_FOLDER',
+        type=str,
+        default=DATA_FOLDER)
+
+    parser.add_argument(
+        '--store-folder',
+        required=False,
+        dest='store_folder',
+        help='Destination of the columnar store. Default is ' + STORE_FOLDER,
+        metavar='STORE_FOLDER',
+        type=str,
+        default=STORE_FOLDER)
+
+    parser.add_argument(
+        '--stringency-path',
+        required=False,
+        dest='stringency_path',
+        help='Prefix of stringency csv files to pack. Default is ' + STRINGENCY_PATH,
+        metavar='STRINGENCY_PATH',
+        type=str,
+        default=STRINGENCY_PATH)
+
+    args = parser.parse_args()
+    return args.data_folder, args.store_folder, args.stringency_path
+
+
+def store_key(file_path, data_folder=DATA_FOLDER):
+    """Data/CovidRussia.csv -> CovidRussia, Data/Russia_region/Tver region.csv -> Russia_region/Tver region"""
+    file_path, data_folder = os.path.abspath(file_path), os.path.abspath(data_folder)
+    if file_path.lower().startswith(data_folder.lower() + os.sep):
+        key = file_path[len(data_folder) + 1:]
+    else:
+        key = os.path.relpath(file_path, data_folder)
+    return key[:-4].replace(os.sep, '/') if key.endswith('.csv') else key.replace(os.sep, '/')
+
+
+def read_table(file_path):
+    """pd.read_csv with the day column always called time (Russian regions call it date)"""
+    df = pd.read_csv(file_path)
+    return df.rename(columns={'date': 'time'})
+
+
+def data_files(data_folder=DATA_FOLDER):
+    """Paths of all csv files of data_folder and its subfolders in sorted order"""
+    for path, subdirs, files in sorted(os.walk(data_folder)):
+        subdirs.sort()
+        for name in sorted(files):
+            if name.endswith('.csv'):
+                yield os.path.join(path, name)
+
+
+def file_tables(file_path, data_folder=DATA_FOLDER):
+    """Yields (key, source csv, DataFrame) of a csv, UsaStates.csv is split by state"""
+    df = read_table(file_path)
+    key = store_key(file_path, data_folder)
+    if 'state' in df.columns:
+        for state, df_state in df.groupby('state', sort=True):
+            yield f'{key}/{state}', file_path, df_state.drop(columns='state')
+    else:
+        yield key, file_path, df
+
+
+def collect_tables(data_folder):
+    """Yields (key, source csv, DataFrame) for every csv in data_folder, UsaStates.csv is split by state"""
+    for file_path in data_files(data_folder):
+        yield from file_tables(file_path, data_folder)
+
+
+def build_store(data_folder=DATA_FOLDER, store_folder=STORE_FOLDER):
+    """
+    Packs all csv files of data_folder into one .npy file per column (rows of all tables one after another)
+    and index.json: key -> offset, length, columns present in the table and source csv.
+    A csv split into several tables (states of UsaStates.csv) is indexed only by its parts: its state column
+    and columns missing in some states do not fit the store, so the csv itself is always read from the file
+    """
+    tables = list(collect_tables(data_folder))
+    columns = {}
+    for key, file_path, df in tables:
+        for column in df.columns:
+            if column != 'time' and df[column].notna().any():
+                values = df[column].dropna().values
+                integral = df[column].notna().all() and np.all(np.mod(values, 1) == 0)
+                columns[column] = columns.get(column, True) and bool(integral)
+
+    total = sum(len(df) for key, file_path, df in tables)
+    arrays = {'time': np.zeros(total, dtype='datetime64[D]')}
+    for column, integral in columns.items():
+        arrays[column] = np.zeros(total, dtype=np.int64) if integral else np.full(total, np.nan)
+
+    index = {}
+    offset = 0
+    for key, file_path, df in tables:
+        present = ['time']
+        arrays['time'][offset:offset + len(df)] = df['time'].to_numpy(dtype=str).astype('datetime64[D]')
+        for column in df.columns:
+            if column in columns and df[column].notna().any():
+                arrays[column][offset:offset + len(df)] = df[column].values
+                present.append(column)
+        index[key] = {'offset': offset, 'length': len(df), 'columns': present,
+                      'source': file_path, 'mtime': os.path.getmtime(file_path)}
+        offset += len(df)
+
+    os.makedirs(store_folder, exist_ok=True)
+    for column, array in arrays.items():
+        np.save(os.path.join(store_folder, f'{column}.npy'), array)
+    with open(os.path.join(store_folder, 'index.json'), 'w') as outfile:
+        json.dump({'data_folder': data_folder, 'tables': index}, outfile, indent=4)
+    open_store.cache_clear()
+    return index
+
+
+def stringency_files(stringency_path=STRINGENCY_PATH):
+    """Country -> csv path of all files named {stringency_path}{Country}.csv"""
+    folder, prefix = os.path.split(stringency_path)
+    return {name[len(prefix):-len('.csv')]: os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.startswith(prefix) and name.endswith('.csv')}
+
+
+def read_stringency(file_path):
+    """Days (datetime64[D]) and stringency index of one csv"""
+    df = pd.read_csv(file_path)
+    return df['Date'].to_numpy(dtype=str).astype('datetime64[D]'), df[STRINGENCY_COLUMN].to_numpy(dtype=float)
+
+
+def build_stringency(stringency_path=STRINGENCY_PATH, store_folder=STORE_FOLDER):
+    """
+    Packs all stringency files into stringency.npy: a country x day array over one day axis for all countries,
+    NaN on days without a value, and stringency.json: first day, number of days and country -> row, source csv
+    """
+    files = stringency_files(stringency_path)
+    series = {country: read_stringency(file_path) for country, file_path in files.items()}
+    known = [days for days, values in series.values() if len(days)]
+    first = min(days.min() for days in known)
+    size = int((max(days.max() for days in known) - first).astype(int)) + 1
+
+    table = np.full((len(series), size), np.nan)
+    index = {}
+    for row, (country, (days, values)) in enumerate(series.items()):
+        table[row, (days - first).astype(int)] = values
+        index[country] = {'row': row, 'source': files[country], 'mtime': os.path.getmtime(files[country])}
+
+    os.makedirs(store_folder, exist_ok=True)
+    np.save(os.path.join(store_folder, 'stringency.npy'), table)
+    with open(os.path.join(store_folder, 'stringency.json'), 'w') as outfile:
+        json.dump({'stringency_path': stringency_path, 'first_day': str(first), 'days': size,
+                   'countries': index}, outfile, indent=4)
+    open_stringency.cache_clear()
+    return index
+
+
+def is_fresh(entry):
+    """False if the source csv of an index entry was changed after it was stored"""
+    try:
+        return os.path.getmtime(entry['source']) <= entry['mtime']
+    except OSError:
+        return False
+
+
+class DataStore(object):
+    def __init__(self, store_folder=STORE_FOLDER):
+        self.store_folder = store_folder
+        with open(os.path.join(store_folder, 'index.json')) as json_file:
+            meta = json.load(json_file)
+        self.data_folder = meta['data_folder']
+        self.index = meta['tables']
+        self.lower_keys = {key.lower(): key for key in self.index}
+        self.arrays = {}
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def resolve(self, key):
+        """Case insensitive lookup of key (callers capitalize file paths), None if there is no such table"""
+        return key if key in self.index else self.lower_keys.get(key.lower())
+
+    def keys(self):
+        return self.index.keys()
+
+    def column(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.store_folder, f'{name}.npy'), mmap_mode='r')
+        return self.arrays[name]
+
+    def is_fresh(self, key):
+        """False if the source csv was changed after the store was built"""
+        return is_fresh(self.index[key])
+
+    def series(self, key):
+        """Column name -> read-only memory-mapped slice, time is datetime64[D]"""
+        entry = self.index[key]
+        start, stop = entry['offset'], entry['offset'] + entry['length']
+        return {name: self.column(name)[start:stop] for name in entry['columns']}
+
+    def frame(self, key):
+        """DataFrame over the memory-mapped slices, time is formatted as in csv files"""
+        series = self.series(key)
+        series['time'] = np.datetime_as_string(series['time'], unit='D')
+        return pd.DataFrame(series, copy=False)
+
+
+class StringencyTable(object):
+    def __init__(self, store_folder=STORE_FOLDER):
+        with open(os.path.join(store_folder, 'stringency.json')) as json_file:
+            meta = json.load(json_file)
+        self.stringency_path = meta['stringency_path']
+        self.index = meta['countries']
+        self.lower_keys = {key.lower(): key for key in self.index}
+        self.days = np.datetime64(meta['first_day'], 'D') + np.arange(meta['days'])
+        self.values = np.load(os.path.join(store_folder, 'stringency.npy'), mmap_mode='r')
+
+    def resolve(self, country):
+        """Case insensitive lookup of country, None if there is no such row"""
+        return country if country in self.index else self.lower_keys.get(country.lower())
+
+    def is_fresh(self, country):
+        return is_fresh(self.index[country])
+
+    def series(self, country):
+        """Stringency index of country over self.days as a read-only memory-mapped row"""
+        return self.values[self.index[country]['row']]
+
+
+@lru_cache(maxsize=None)
+def open_store(store_folder=STORE_FOLDER):
+    try:
+        return DataStore(store_folder)
+    except (OSError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=None)
+def open_stringency(store_folder=STORE_FOLDER):
+    try:
+        return StringencyTable(store_folder)
+    except (OSError, ValueError):
+        return None
+
+
+def load_table(file_path, store_folder=STORE_FOLDER):
+    """
+    Table of file_path from the columnar store if it is there and up to date,
+    otherwise the csv itself is read
+    """
+    store = open_store(store_folder)
+    if store is not None:
+        key = store.resolve(store_key(file_path, store.data_folder))
+        if key is not None and store.is_fresh(key):
+            return store.frame(key)
+    return read_table(file_path)
+
+
+def load_columns(file_path, store_folder=STORE_FOLDER):
+    """
+    Like load_table, but column name -> numpy array with time as datetime64[D],
+    tables of the store are memory-mapped slices and are not copied
+    """
+    store = open_store(store_folder)
+    if store is not None:
+        key = store.resolve(store_key(file_path, store.data_folder))
+        if key is not None and store.is_fresh(key):
+            return store.series(key)
+    df = read_table(file_path)
+    columns = {name: df[name].to_numpy() for name in df.columns}
+    columns['time'] = df['time'].to_numpy(dtype=str).astype('datetime64[D]')
+    return columns
+
+
+def stringency_series(country, stringency_path=STRINGENCY_PATH, store_folder=STORE_FOLDER):
+    """
+    Days (datetime64[D]) and stringency index of country. From the packed table these are the common day axis
+    and the country's row with NaN on missing days, otherwise (no table, a changed or a new csv) the csv is read:
+    {stringency_path}{country}.csv as it is named in stringency_files or, for a name typed in lower case,
+    with the first letter capitalized. Raises OSError if there is no stringency file of the country
+    """
+    table = open_stringency(store_folder)
+    if table is not None and table.stringency_path == stringency_path:
+        key = table.resolve(str(country))
+        if key is not None and table.is_fresh(key):
+            return table.days, table.series(key)
+    file_path = f'{stringency_path}{country}.csv'
+    if not os.path.exists(file_path):
+        file_path = f'{stringency_path}{str(country).capitalize()}.csv'
+    return read_stringency(file_path)
+
+
+def json_values(values):
+    """Nested lists of floats of an array with null for NaN"""
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isnan(values), None, values.astype(object)).tolist()
+
+
+def array_paths(data, prefix=''):
+    """Yields ('key/nested key', array) of all numpy arrays in nested dicts of data"""
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            yield prefix + key, value
+        elif isinstance(value, dict):
+            yield from array_paths(value, f'{prefix}{key}/')
+
+
+def replace_path(data, path, value):
+    """Copy of nested dicts of data with value at 'key/nested key', the key is removed if value is None"""
+    key, _, rest = path.partition('/')
+    data = dict(data)
+    if rest:
+        data[key] = replace_path(data[key], rest, value)
+    elif value is None:
+        del data[key]
+    else:
+        data[key] = value
+    return data
+
+
+def save_artifact(folder_path, data, binary=False):
+    """
+    Writes data (nested dicts with numpy arrays of floats among the values) to folder_path/data.json.
+    Arrays become lists with null for NaN, or with binary rows of one float64 arrays.npy padded with NaN:
+    data.json then keeps only their rows, shapes and the content key of arrays.npy under 'arrays'
+    """
+    arrays = dict(array_paths(data))
+    if binary and arrays:
+        width = max(values.shape[-1] for values in arrays.values())
+        table = np.full((sum(int(np.prod(values.shape[:-1])) for values in arrays.values()), width), np.nan)
+        index, row = {}, 0
+        for path, values in arrays.items():
+            rows = values.reshape(-1, values.shape[-1])
+            table[row:row + len(rows), :values.shape[-1]] = rows
+            index[path] = {'row': row, 'shape': list(values.shape)}
+            row += len(rows)
+            data = replace_path(data, path, None)
+        with open(folder_path + ARRAYS_FILE + '.tmp', 'wb') as outfile:
+            np.save(outfile, table)
+        os.replace(folder_path + ARRAYS_FILE + '.tmp', folder_path + ARRAYS_FILE)
+        data = dict(data, arrays={'file': ARRAYS_FILE, 'key': content_key(table), 'series': index})
+    else:
+        for path, values in arrays.items():
+            data = replace_path(data, path, json_values(values))
+
+    with open(folder_path + ARTIFACT_FILE + '.tmp', 'w') as outfile:
+        json.dump(data, outfile, indent=4)
+    os.replace(folder_path + ARTIFACT_FILE + '.tmp', folder_path + ARTIFACT_FILE)
+
+
+def attach_arrays(folder_path, data, mmap_mode='r'):
+    """
+    Content of a data.json with arrays of its arrays.npy put back at their places as memory-mapped views,
+    data of a json-only artifact is returned as it is
+    """
+    if 'arrays' not in data:
+        return data
+    table = np.load(folder_path + data['arrays']['file'], mmap_mode=mmap_mode)
+    series = data['arrays']['series']
+    data = replace_path(data, 'arrays', None)
+    for path, entry in series.items():
+        shape = entry['shape']
+        rows = int(np.prod(shape[:-1]))
+        values = table[entry['row']:entry['row'] + rows, :shape[-1]]
+        data = replace_path(data, path, values[0] if len(shape) == 1 else values.reshape(shape))
+    return data
+
+
+def load_artifact(folder_path, mmap_mode='r'):
+    """folder_path/data.json with its arrays, raises OSError or ValueError if it can not be read"""
+    with open(folder_path + ARTIFACT_FILE) as json_file:
+        return attach_arrays(folder_path, json.load(json_file), mmap_mode)
+
+
+def main():
+    data_folder, store_folder, stringency_path = parse_arguments()
+    index = build_store(data_folder, store_folder)
+    print(f"{len(index)} tables from {data_folder} are stored in {store_folder}")
+    index = build_stringency(stringency_path, store_folder)
+    print(f"{len(index)} stringency files of {stringency_path} are packed in {store_folder}")
+
+
+if __name__ == '__main__':
+    main()
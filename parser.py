@@ -1,24 +1,211 @@
-import sys
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, deque
+from itertools import islice
+from urllib.parse import urlsplit
+import hashlib
 import pandas as pd
+import numpy as np
 import requests
+import argparse
+import threading
+import time
 import json
+import os
 import re
 
 
-def problems_with_json(func):
-    def wrapper(*args):
+BASE_URL = 'https://www.worldometers.info'
+FETCH_META_FOLDER = 'Data/.fetch_meta'
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        'country',
+        help='Name of country as in Worldometer links, usa_states to parse all USA states '
+             'or all to refresh every country from --country-list',
+        metavar='COUNTRY_NAME',
+        type=str)
+
+    parser.add_argument(
+        '--workers',
+        required=False,
+        dest='workers',
+        help='Number of pages fetched concurrently. Defaults to 8',
+        metavar='WORKERS',
+        type=int,
+        default=8)
+
+    parser.add_argument(
+        '--rate',
+        required=False,
+        dest='rate',
+        help='Maximum number of requests per second to one host, 0 means no limit. Defaults to 10',
+        metavar='RATE',
+        type=float,
+        default=10)
+
+    parser.add_argument(
+        '--base-url',
+        required=False,
+        dest='base_url',
+        help='Worldometer address, can point to a local server with saved pages. Default is ' + BASE_URL,
+        metavar='BASE_URL',
+        type=str,
+        default=BASE_URL)
+
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        dest='incremental',
+        help='Send conditional request, skip unchanged page and append only new days to existing Data/Covid<Country>.csv')
+
+    parser.add_argument(
+        '--country-list',
+        required=False,
+        dest='country_list',
+        help='Where all takes countries from: data (Data/Covid*.csv) or population (population_dict.py). '
+             'Default is data',
+        choices=['data', 'population'],
+        default='data')
+
+    parser.add_argument(
+        '--retries',
+        required=False,
+        dest='retries',
+        help='Retries of a failed request in all mode, delays grow exponentially. Defaults to 3',
+        metavar='RETRIES',
+        type=int,
+        default=3)
+
+    parser.add_argument(
+        '--backoff',
+        required=False,
+        dest='backoff',
+        help='First delay before retry in seconds. Defaults to 1',
+        metavar='BACKOFF',
+        type=float,
+        default=1)
+
+    parser.add_argument(
+        '--report',
+        required=False,
+        dest='report',
+        help='Where all mode writes json report about every country. Default is parser_report.json',
+        metavar='REPORT_PATH',
+        type=str,
+        default='parser_report.json')
+
+    return parser.parse_args()
+
+
+class HostRateLimiter(object):
+    """
+    Spaces out requests to the same host so that there are at most `rate` of them per second,
+    with per_host=False the limit is global for all hosts
+    """
+    def __init__(self, rate, per_host=True):
+        self.interval = 1 / rate if rate else 0
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.next_slot = defaultdict(float)
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc if self.per_host else ''
+        with self.lock:
+            slot = max(time.monotonic(), self.next_slot[host])
+            self.next_slot[host] = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_session(pool_size):
+    """One keep-alive session whose connection pool is big enough for all workers"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_all(urls, session, workers, limiter, timeout=30):
+    """
+    Yields responses (None for failed requests) in the order of urls while fetching them concurrently,
+    at most `workers` requests are in flight: the next url is submitted as each response is consumed
+    """
+    def fetch(url):
+        limiter.wait(url)
         try:
-            func(*args)
-        except:
-            print("problems with {}".format(func.__name__))
-    return wrapper
-
-
-def text_slice(start_str, end_str, text):
-    text = text[text.find(start_str) + len(start_str):]
-    text = text[:text.find(end_str)].strip()
-    return text
+            return session.get(url, timeout=timeout)
+        except requests.RequestException:
+            return None
+
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(fetch, url) for url in islice(urls, workers))
+        while pending:
+            response = pending.popleft().result()
+            pending.extend(executor.submit(fetch, url) for url in islice(urls, 1))
+            yield response
+
+
+def fetch_meta_path(csv_path):
+    return os.path.join(FETCH_META_FOLDER, os.path.basename(csv_path)[:-4] + '.json')
+
+
+def load_fetch_meta(csv_path):
+    """ETag, Last-Modified and content hash of the previous fetch of csv_path, {} if unknown"""
+    try:
+        with open(fetch_meta_path(csv_path)) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_fetch_meta(csv_path, meta):
+    os.makedirs(FETCH_META_FOLDER, exist_ok=True)
+    path = fetch_meta_path(csv_path)
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(meta, outfile, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def conditional_headers(meta):
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def read_csv_header(csv_path):
+    try:
+        with open(csv_path) as csv_file:
+            return csv_file.readline().strip().split(',')
+    except OSError:
+        return None
+
+
+def read_csv_last_date(csv_path, block=4096):
+    """Date in the first column of the last row of csv_path read from the tail of the file, None if there is no row"""
+    try:
+        with open(csv_path, 'rb') as csv_file:
+            size = csv_file.seek(0, os.SEEK_END)
+            csv_file.seek(max(size - block, 0))
+            lines = csv_file.read().decode().strip().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return None
+    if not lines:
+        return None
+    try:
+        return str(np.datetime64(lines[-1].split(',')[0], 'D'))
+    except ValueError:
+        return None
 
 
 from_str_date_to_date = {
@@ -26,13 +213,76 @@ from_str_date_to_date = {
         'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
     }
 
+""" Highcharts series name -> attribute of Covid """
+series_names = {
+    'Cases': 'total_cases',
+    'Daily Cases': 'daily_cases',
+    'Currently Infected': 'total_currently_infected',
+    'Deaths': 'total_death',
+    'Daily Deaths': 'death_per_day',
+    'New Recoveries': 'new_recoveries',
+}
+
+highcharts_token = re.compile(r"(?:\btitle: *\{\s*text: '(?P<title>[^']*)'"
+                              r"|categories: *\[(?P<categories>[^\]]*)\]"
+                              r"|name: '(?P<name>[^']*)'"
+                              r"|data: *\[(?P<data>[^\]]*)\])")
+
+category_date = re.compile(r'"(\w{3}) (\d{1,2})(?:, (\d{4}))?"')
+
+
+def parse_numbers(raw):
+    """Comma separated numbers with nulls -> int64 array (float64 if there are fractions), null is 0"""
+    if not raw.strip():
+        return np.array([], dtype=np.int64)
+    values = np.array(raw.split(','))
+    values[np.char.strip(values) == 'null'] = '0'
+    try:
+        return values.astype(np.int64)
+    except ValueError:
+        return values.astype(np.float64)
+
+
+def parse_dates(raw):
+    """'"Feb 15","Feb 16"' or '"Feb 15, 2021",...' -> datetime64[D] array, year defaults to 2020"""
+    days = [f'{year or 2020}-{from_str_date_to_date[month]:02d}-{int(day):02d}'
+            for month, day, year in category_date.findall(raw)]
+    return np.array(days, dtype='datetime64[D]')
+
+
+def extract_series(text):
+    """
+    Walks over Highcharts blocks of a Worldometer page once and returns found series as numpy arrays:
+    time (categories of 'Total Cases' chart) and the first data of every chart from series_names
+    """
+    series = {}
+    title = name = None
+    for token in highcharts_token.finditer(text):
+        kind = token.lastgroup
+        if kind == 'title':
+            title = token.group('title')
+        elif kind == 'categories':
+            if title == 'Total Cases' and 'time' not in series:
+                series['time'] = parse_dates(token.group('categories'))
+        elif kind == 'name':
+            name = token.group('name')
+        elif kind == 'data':
+            key = series_names.get(name)
+            if key and key not in series:
+                series[key] = parse_numbers(token.group('data'))
+            name = None
+    return series
+
 
 class Covid:
-    def __init__(self, country):
+    def __init__(self, country, session=None, base_url=BASE_URL, headers=None, timeout=30):
         self.country = country
-        self.url = f'https://www.worldometers.info/coronavirus/country/{self.country.strip().lower()}/'
-        self.source = requests.get(self.url)
+        self.url = f'{base_url}/coronavirus/country/{self.country.strip().lower()}/'
+        self.source = (session or requests).get(self.url, headers=headers, timeout=timeout)
+
+        self.clear()
 
+    def clear(self):
         self.time = []
         self.total_cases = []
         self.daily_cases = []
@@ -41,139 +291,205 @@ class Covid:
         self.death_per_day = []
         self.new_recoveries = []
 
-    def get_datetime_from_str_day(self):
-        for i in range(len(self.time)):
-            self.time[i] = date(2020, from_str_date_to_date[self.time[i][:3]], int(self.time[i][-2:]))
-
-    def get_time(self):
-        total_cases_time = text_slice("text: 'Total Cases'", "yAxis: {", self.source.text)
-        total_cases_time = text_slice("categories:", "},", total_cases_time)
-        self.time = json.loads(total_cases_time)
-        self.get_datetime_from_str_day()
-
-    @problems_with_json
-    def get_total_cases(self):
-        total_cases = text_slice("name: 'Cases',", "responsive: {", self.source.text)
-        total_cases = text_slice("data:", "}],", total_cases)
-        self.total_cases = json.loads(total_cases.replace('null', '0'))
-
-    @problems_with_json
-    def get_daily_cases(self):
-        daily_cases = text_slice("name: 'Daily Cases',", "},", self.source.text)
-        daily_cases += ';'
-        daily_cases = text_slice("data: ", ";", daily_cases)
-        self.daily_cases = json.loads(daily_cases.replace('null', '0'))
-
-    @problems_with_json
-    def get_total_currently_infected(self):
-        total_currently_infected = text_slice("name: 'Currently Infected'", "}", self.source.text)
-        total_currently_infected += ";"
-        total_currently_infected = text_slice("data: ", ";", total_currently_infected)
-        self.total_currently_infected = json.loads(total_currently_infected.replace('null', '0'))
-
-    @problems_with_json
-    def get_total_death(self):
-        total_death = text_slice("name: 'Deaths',", "],", self.source.text)
-        total_death = text_slice("data: ", "}", total_death)
-        self.total_death = json.loads(total_death.replace('null', '0'))
-
-    @problems_with_json
-    def get_death_per_day(self):
-        death_per_day = text_slice("name: 'Daily Deaths'", "}", self.source.text)
-        death_per_day += ";"
-        death_per_day = text_slice("data: ", ";", death_per_day)
-        self.death_per_day = json.loads(death_per_day.replace('null', '0'))
-
-    @problems_with_json
-    def get_new_recoveries(self):
-        new_recoveries = text_slice("name: 'New Recoveries'", "}", self.source.text)
-        new_recoveries += ";"
-        new_recoveries = text_slice("data: ", ";", new_recoveries)
-        self.new_recoveries = json.loads(new_recoveries.replace('null', '0'))
+    def parse(self):
+        """Fills all series from self.source in one pass, raises ValueError if there is no time axis"""
+        series = extract_series(self.source.text)
+        if not len(series.get('time', [])):
+            raise ValueError(f'no time axis on {self.source.url}')
+        self.time = series['time']
+        for key in series_names.values():
+            if key in series:
+                setattr(self, key, series[key])
+            else:
+                print("problems with {}".format(key))
+
+    def csv_path(self):
+        return f'Data/{self.__class__.__name__}{self.country.capitalize()}.csv'
 
-    def write_to_csv(self):
+    def to_frame(self):
         df = pd.DataFrame()
-        for key, value in self.__dict__.items():
-            if issubclass(type(value), list) and len(value):
+        for key in ['time'] + list(series_names.values()):
+            value = getattr(self, key)
+            if len(value):
                 df[key] = value
-        df.to_csv(f'Data/{self.__class__.__name__}{self.country.capitalize()}.csv', index=False)
-
-
-class CovidUsaStates(Covid):
-    def __init__(self):
-        super().__init__("")
-        all_states_source = requests.get("https://www.worldometers.info/coronavirus/country/us/")
-        self.all_states = list(set(re.findall('="/coronavirus/usa/(\w+-?\w*-?\w*)', all_states_source.text)))
+        return df
 
     def write_to_csv(self):
-        data = {}
-        columns = list(filter(lambda key: key in ['time', 'total_cases', 'daily_cases', 'total_currently_infected',
-                                                  'total_death', 'death_per_day', 'new_recoveries'], list(self.__dict__.keys()))) + ['state']
-        df = pd.DataFrame(columns=columns)
-        for state in self.all_states:
-            self.source = requests.get(f'https://www.worldometers.info/coronavirus/usa/{state}/')
-
+        self.to_frame().to_csv(self.csv_path(), index=False)
+
+    def append_to_csv(self, since):
+        """Appends days after `since` (YYYY-MM-DD) to the existing csv, returns number of appended rows"""
+        df = self.to_frame()
+        df = df[df['time'] > np.datetime64(since)]
+        if len(df):
+            df.to_csv(self.csv_path(), mode='a', header=False, index=False)
+        return len(df)
+
+
+def refresh_country(country, session=None, base_url=BASE_URL):
+    """
+    Incremental refresh of Data/Covid<Country>.csv: conditional request with the saved ETag/Last-Modified,
+    nothing is parsed if the page (or its hash) did not change, otherwise only days after the last row
+    of the csv are appended, so the file may also have been rewritten by a plain run in between.
+    Returns a short description of what was done
+    """
+    csv_path = f'Data/Covid{country.capitalize()}.csv'
+    header = read_csv_header(csv_path)
+    meta = load_fetch_meta(csv_path) if header else {}
+
+    data = Covid(country, session, base_url, conditional_headers(meta))
+    if data.source.status_code == 304:
+        return 'not modified'
+    data.source.raise_for_status()
+
+    content_hash = hashlib.sha256(data.source.content).hexdigest()
+    new_meta = {'etag': data.source.headers.get('ETag'),
+                'last_modified': data.source.headers.get('Last-Modified'),
+                'content_hash': content_hash}
+    if content_hash == meta.get('content_hash'):
+        save_fetch_meta(csv_path, new_meta)
+        return 'unchanged'
+
+    data.parse()
+    df_columns = list(data.to_frame().columns)
+    last_date = read_csv_last_date(csv_path) if header == df_columns else None
+    if last_date:
+        result = f'appended {data.append_to_csv(last_date)} days'
+    else:
+        data.write_to_csv()
+        result = 'written'
+
+    save_fetch_meta(csv_path, new_meta)
+    return result
+
+
+def scrape_country(country, session=None, base_url=BASE_URL, incremental=False):
+    if incremental:
+        return refresh_country(country, session, base_url)
+    data = Covid(country, session, base_url)
+    data.source.raise_for_status()
+    data.parse()
+    data.write_to_csv()
+    return 'written'
+
+
+def is_transient(error):
+    """Network problems, timeouts, 429 and 5xx answers are worth retrying, broken links and pages are not"""
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and (error.response.status_code == 429 or error.response.status_code >= 500)
+    return isinstance(error, requests.RequestException)
+
+
+def bulk_countries(country_list):
+    if country_list == 'population':
+        from population_dict import population_dict
+        return sorted(name.lower() for name in population_dict)
+    return sorted(name[len('Covid'):-len('.csv')].lower() for name in os.listdir('Data')
+                  if name.startswith('Covid') and name.endswith('.csv'))
+
+
+def scrape_all(countries, workers=8, rate=10, base_url=BASE_URL, incremental=False, retries=3, backoff=1):
+    """
+    Scrapes countries in a pool of workers sharing one session and a global rate limit.
+    Failed transient requests are retried after backoff, 2 * backoff, 4 * backoff... seconds.
+    Returns report with result or error, number of attempts and latency of every country
+    """
+    session = make_session(workers)
+    limiter = HostRateLimiter(rate, per_host=False)
+
+    def job(country):
+        start = time.monotonic()
+        for attempt in range(1, retries + 2):
+            limiter.wait(base_url)
             try:
-                self.get_time()
-            except:
-                print(f"probably, invalid link ({state})")
-
-            self.get_total_cases()
-            self.get_daily_cases()
-            self.get_total_currently_infected()
-            self.get_total_death()
-            self.get_death_per_day()
-            self.get_new_recoveries()
-
-            if data.get(state):
-                pass
-            else:
-                data[state] = {}
-
-            df_tmp = pd.DataFrame(columns=columns)
-
-            for key, value in self.__dict__.items():
-                if issubclass(type(value), list) and len(value) and key != 'all_states':
-                    if data[state].get(key):
-                        pass
-                    else:
-                        data[state][key] = ""
-
-                    data[state][key] = value
+                result = scrape_country(country, session, base_url, incremental)
+                return {'status': 'ok', 'result': result, 'attempts': attempt,
+                        'latency': time.monotonic() - start}
+            except Exception as error:
+                if attempt > retries or not is_transient(error):
+                    return {'status': 'failed', 'error': f'{error.__class__.__name__}: {error}', 'attempts': attempt,
+                            'latency': time.monotonic() - start}
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    started = time.time()
+    report = {'countries': {}}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job, country): country for country in countries}
+        for future in as_completed(futures):
+            country = futures[future]
+            report['countries'][country] = future.result()
+            print(f"{country}: {report['countries'][country].get('result') or report['countries'][country]['error']}")
+
+    statuses = [info['status'] for info in report['countries'].values()]
+    report.update({'started': started, 'elapsed': time.time() - started,
+                   'succeeded': statuses.count('ok'), 'failed': statuses.count('failed')})
+    report['countries'] = dict(sorted(report['countries'].items()))
+    return report
 
-                    df_tmp[key] = value
 
-            df_tmp['state'] = state
-            df = pd.concat((df, df_tmp))
-
-            data = {}
-            self.time, self.total_death, self.total_cases, self.total_currently_infected, self.death_per_day, \
-                self.new_recoveries, self.daily_cases = [], [], [], [], [], [], []
+class CovidUsaStates(Covid):
+    def __init__(self, workers=8, rate=10, base_url=BASE_URL):
+        self.base_url = base_url
+        self.workers = workers
+        self.session = make_session(workers)
+        self.limiter = HostRateLimiter(rate)
+        super().__init__("us", self.session, base_url)
+        self.all_states = sorted(set(re.findall(r'="/coronavirus/usa/(\w+-?\w*-?\w*)', self.source.text)))
 
-        df.to_csv('Data/UsaStates.csv', index=False)
+    def write_to_csv(self):
+        """Streams every state block to Data/UsaStates.csv as soon as its page is parsed"""
+        columns = ['time'] + list(series_names.values()) + ['state']
+        urls = [f'{self.base_url}/coronavirus/usa/{state}/' for state in self.all_states]
+        sources = fetch_all(urls, self.session, self.workers, self.limiter)
+        with open('Data/UsaStates.csv.tmp', 'w', newline='') as outfile:
+            outfile.write(','.join(columns) + '\n')
+            for state, self.source in zip(self.all_states, sources):
+                self.clear()
+                try:
+                    if self.source is None:
+                        raise ValueError(state)
+                    self.parse()
+                except ValueError:
+                    print(f"probably, invalid link ({state})")
+                    continue
+
+                df = self.to_frame()
+                df['state'] = state
+                df.reindex(columns=columns).to_csv(outfile, header=False, index=False)
+
+        os.replace('Data/UsaStates.csv.tmp', 'Data/UsaStates.csv')
 
 
 def main():
-    country = sys.argv[1]
+    args = parse_arguments()
+    country = args.country
+
+    if country == 'all':
+        report = scrape_all(bulk_countries(args.country_list), args.workers, args.rate, args.base_url,
+                            args.incremental, args.retries, args.backoff)
+        with open(args.report, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+        print(f"succeeded: {report['succeeded']}, failed: {report['failed']}, "
+              f"elapsed: {report['elapsed']:.1f}s, report: {args.report}")
+
+    elif country != 'usa_states' and args.incremental:
+        try:
+            print(f'{country}: {refresh_country(country, base_url=args.base_url)}')
+        except (ValueError, requests.RequestException):
+            print('probably, invalid link (country)')
 
-    if country != 'usa_states':
-        data = Covid(country)
+    elif country != 'usa_states':
+        data = Covid(country, base_url=args.base_url)
         try:
-            data.get_time()
-        except:
+            data.parse()
+        except ValueError:
             print('probably, invalid link (country)')
             return
-        data.get_total_cases()
-        data.get_daily_cases()
-        data.get_total_currently_infected()
-        data.get_total_death()
-        data.get_death_per_day()
-        data.get_new_recoveries()
 
         data.write_to_csv()
 
     else:
-        data = CovidUsaStates()
+        data = CovidUsaStates(args.workers, args.rate, args.base_url)
         data.write_to_csv()
 
 
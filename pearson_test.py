@@ -1,13 +1,21 @@
 import json
-from scipy.stats import chisquare
-from scipy.stats import chi2
 import scipy.stats as stats
+import pandas as pd
 import numpy as np
+from timeit import default_timer as timer
+from result_cache import ResultCache, content_key, CACHE_FOLDER
+from data_store import attach_arrays
 import argparse
 import sys
 import os
 
 
+SIR_FOLDER = 'SIR'
+SERIES = ['infected', 'recovered']
+CONFIDENCE = 0.95
+RESULTS_FILE = 'SIR/PearsonSIRResults.csv'
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
 
@@ -15,93 +23,189 @@ def parse_arguments():
         '--countries',
         action='store',
         dest='countries',
-        help='Name of country/countries separated by comma without spaces' +
-             'It must exact match the data names or you will get out of bonds error.',
+        help='Name of country/countries separated by comma without spaces. '
+             'Defaults to all countries with SIR/<country>/data.json',
         metavar='COUNTRY_NAMES',
         type=str,
         default="")
 
+    parser.add_argument(
+        '--cache',
+        action='store_true',
+        dest='cache',
+        help='Reuse results of countries whose SIR/<country>/data.json did not change')
+
+    parser.add_argument(
+        '--cache-folder',
+        required=False,
+        dest='cache_folder',
+        help='Folder of the result cache. Default is ' + CACHE_FOLDER,
+        metavar='CACHE_FOLDER',
+        type=str,
+        default=CACHE_FOLDER)
+
+    parser.add_argument(
+        '--output',
+        required=False,
+        dest='output',
+        help='Table with results of all countries. Default is ' + RESULTS_FILE,
+        metavar='OUTPUT',
+        type=str,
+        default=RESULTS_FILE)
+
     args = parser.parse_args()
 
     try:
         countries_raw = args.countries
-        country_list = countries_raw.split(",")
+        country_list = countries_raw.split(",") if countries_raw else fitted_countries()
     except Exception:
         sys.exit("QUIT: countries parameter are not in correct format")
 
-    return country_list
+    return country_list, args.output, ResultCache(args.cache_folder) if args.cache else None
+
+
+def fitted_countries(folder=SIR_FOLDER):
+    """Countries with a data.json of SIR.py in folder"""
+    return sorted(name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name, 'data.json')))
+
+
+def data_curves(data):
+    """Fact and predicted series of data.json (lists or arrays) without the first day (it is zero), null -> NaN"""
+    return {f'{kind}_{name}': np.array(data[f'{kind}_{name}'][1:], dtype=float)
+            for kind in ('fact', 'predicted') for name in SERIES}
+
+
+def pack_curves(curves):
+    """Name -> countries x days array of curves of all countries, shorter ones are padded with NaN"""
+    width = max(len(values) for curve in curves for values in curve.values())
+    packed = {}
+    for name in curves[0]:
+        packed[name] = np.full((len(curves), width), np.nan)
+        for row, curve in enumerate(curves):
+            packed[name][row, :len(curve[name])] = curve[name]
+    return packed
+
+
+def masked_std(values, mask, days):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.sum(np.where(mask, values, 0), axis=1, keepdims=True) / days[:, None]
+        return np.sqrt(np.sum(np.where(mask, (values - mean) ** 2, 0), axis=1, keepdims=True) / days[:, None])
+
+
+def scaled_chi_square(fact, predicted):
+    """
+    χ² statistic of fact against predicted for every row over the days where both are known (padding of
+    unknown days is NaN), each series is scaled by its standard deviation over these days.
+    Returns statistics and numbers of days
+    """
+    mask = ~np.isnan(fact) & ~np.isnan(predicted)
+    days = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fact = fact / masked_std(fact, mask, days)
+        predicted = predicted / masked_std(predicted, mask, days)
+        statistic = np.sum(np.where(mask, (fact - predicted) ** 2 / predicted, 0), axis=1)
+    statistic[days == 0] = np.nan
+    return statistic, days
+
+
+def pearson_results(curves):
+    """
+    Results of the χ² test for every country from a list of data_curves, all countries are tested at once.
+    The critical value is the CONFIDENCE quantile of χ² with (days of infected - 1) degrees of freedom
+    """
+    packed = pack_curves(curves)
+    statistics = {}
+    for name in SERIES:
+        statistics[name], days = scaled_chi_square(packed[f'fact_{name}'], packed[f'predicted_{name}'])
+        if name == SERIES[0]:
+            critical_values = stats.chi2.ppf(q=CONFIDENCE, df=days - 1)
+
+    results = []
+    for row, critical_value in enumerate(critical_values):
+        fin_data = {'critical_value': float(critical_value)}
+        fin_data.update({f'{name}_statistic': float(statistics[name][row]) for name in SERIES})
+        fin_data.update({f'{name}_validation': bool(statistics[name][row] <= critical_value) for name in SERIES})
+        results.append(fin_data)
+    return results
+
+
+def validate(pearsons, cache=None):
+    """
+    Country -> results of the χ² test of data.json of every Pearson object. Data of all countries which are not
+    in the cache are tested in one batch, results are saved to their PearsonSIR<country>.json files
+    """
+    results, pending = {}, []
+    for pearson in pearsons:
+        raw_data = pearson.read()
+        if raw_data is None:
+            continue
+        key = content_key(raw_data, {'q': CONFIDENCE}) if cache else None
+        cached = cache.get('pearson_sir', key) if cache else None
+        if cached is not None:
+            results[pearson.country] = {name: value.item() for name, value in cached.items()}
+        else:
+            pending.append((pearson, key, data_curves(attach_arrays(pearson.folder_path, json.loads(raw_data)))))
 
+    if pending:
+        for (pearson, key, curves), fin_data in zip(pending, pearson_results([curves for _, _, curves in pending])):
+            if cache:
+                cache.put('pearson_sir', key, fin_data)
+            results[pearson.country] = fin_data
 
-class Pearson(object):
-    def __init__(self, country):
-        self.country = country
+    for pearson in pearsons:
+        if pearson.country in results:
+            pearson.save(results[pearson.country])
+    return results
 
 
-    def train(self):
-        file_name = "SIR/{}/data.json".format(str(self.country))
+class Pearson(object):
+    def __init__(self, country, cache=None):
+        self.country = country
+        self.cache = cache
+        self.folder_path = f"{SIR_FOLDER}/{self.country}/"
+
+    def read(self):
+        """
+        Raw SIR/<country>/data.json or None if there is no file. Series saved to arrays.npy are not in it,
+        but the content key of arrays.npy is
+        """
+        file_name = f"{self.folder_path}data.json"
         try:
-            with open(file_name) as json_file:
-                data = json.load(json_file)
-        except:
+            with open(file_name, 'rb') as json_file:
+                return json_file.read()
+        except OSError:
             print("There is no file {} -- train func".format(file_name))
-            return
-
-        """ Deleted the first day to get rid of ZEROs """
-        inf_fact_data = np.asarray(data['fact_infected'][1:])
-        inf_pred_data = np.asarray(data['predicted_infected'][1:])
-        rec_fact_data = np.asarray(data['fact_recovered'][1:])
-        rec_pred_data = np.asarray(data['predicted_recovered'][1:])
-
-        """ Degrees of freedom """
-        df_inf = len(inf_fact_data) - 1
-        df_rec = len(rec_fact_data) - 1
-
-        """ Scaling data """
-        inf_fact_data_sc = inf_fact_data / inf_fact_data.std()
-        inf_pred_data_sc = inf_pred_data / inf_pred_data.std()
-        rec_fact_data_sc = rec_fact_data / rec_fact_data.std()
-        rec_pred_data_sc = rec_pred_data / rec_pred_data.std()
-
+            return None
 
-        """ Scipy calculations """
-        chi_inf = chisquare(f_obs=inf_fact_data_sc, f_exp=inf_pred_data_sc)
-        chi_rec = chisquare(f_obs=rec_fact_data_sc, f_exp=rec_pred_data_sc)
-        print("Infected -- χ² statistic, p-value: ", chi_inf)
-        print("Recovered -- χ² statistic, p-value: ", chi_rec)
-
-        critical_value = stats.chi2.ppf(q=0.95, df=df_inf)
-        print("Critical value: ", critical_value)
-
-        if chi_inf.statistic > critical_value:
-            infected_validation = False
-        else:
-            infected_validation = True
+    def train(self):
+        fin_data = validate([self], self.cache).get(self.country)
+        if fin_data is None:
+            return
+        print("Infected -- χ² statistic: ", fin_data['infected_statistic'])
+        print("Recovered -- χ² statistic: ", fin_data['recovered_statistic'])
+        print("Critical value: ", fin_data['critical_value'])
 
-        if chi_rec.statistic > critical_value:
-            recovered_validation = False
-        else:
-            recovered_validation = True
-
-        fin_data = {
-            'critical_value': critical_value,
-            'infected_statistic': chi_inf.statistic,
-            'recovered_statistic': chi_rec.statistic,
-            'infected_validation': infected_validation,
-            'recovered_validation': recovered_validation
-            }
-
-        folder_path = f"SIR/{self.country}/"
-        os.makedirs(folder_path, exist_ok=True)
-        with open(folder_path + f'PearsonSIR{self.country}.json', 'w') as outfile:
+    def save(self, fin_data):
+        os.makedirs(self.folder_path, exist_ok=True)
+        with open(self.folder_path + f'PearsonSIR{self.country}.json', 'w') as outfile:
             json.dump(fin_data, outfile, indent=4)
 
 
 def main():
-    countries = parse_arguments()
-
-    for country in countries:
-        validation = Pearson(country)
-        validation.train()
+    countries, output, cache = parse_arguments()
+
+    start = timer()
+    results = validate([Pearson(country, cache) for country in countries], cache)
+    table = pd.DataFrame([dict(country=country, **fin_data) for country, fin_data in results.items()],
+                         columns=['country', 'critical_value'] + [f'{name}_statistic' for name in SERIES] +
+                                 [f'{name}_validation' for name in SERIES])
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    table.to_csv(output, index=False)
+
+    failed = {name: int((~table[f'{name}_validation'].astype(bool)).sum()) for name in SERIES}
+    print(f"{len(table)} countries, infected fit is rejected for {failed['infected']}, "
+          f"recovered fit for {failed['recovered']}, results are in {output} ({timer() - start:.2f}s)")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+
+CACHE_FOLDER = '.cache'
+CACHE_SIZE = 256 * 2 ** 20
+
+
+def content_key(*parts):
+    """sha256 of arrays (dtype, shape and bytes), bytes and json-serializable configuration"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(f'{part.dtype.str}{part.shape}'.encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, bytes):
+            digest.update(part)
+        else:
+            digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Results stored as .npz files named by content key in folder/namespace/.
+    Reading a result refreshes its modification time, and when the folder grows over max_bytes
+    the least recently used results are removed
+    """
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=CACHE_SIZE):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def path(self, namespace, key):
+        return os.path.join(self.folder, namespace, f'{key}.npz')
+
+    def get(self, namespace, key):
+        """Dict name -> array stored under key or None"""
+        path = self.path(namespace, key)
+        try:
+            with np.load(path, allow_pickle=False) as stored:
+                values = {name: stored[name] for name in stored.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return values
+
+    def put(self, namespace, key, values):
+        path = self.path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            np.savez(outfile, **values)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path, subdirs, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith('.npz'):
+                    try:
+                        stat = os.stat(os.path.join(path, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(path, name)))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
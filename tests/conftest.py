@@ -0,0 +1,29 @@
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_folder(folder):
+    """Starts http.server on a free port serving folder, returns the server and its base url"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(folder)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    """Empty working directory with a Data folder, scripts write their csv files there"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('Data')
+    return tmp_path
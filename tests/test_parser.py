@@ -0,0 +1,102 @@
+import os
+
+import pandas as pd
+import pytest
+
+import parser
+import legacy_parser
+from conftest import serve_folder
+
+
+def write_country_page(folder, country, days):
+    """Minimal Worldometer country page with the 'Total Cases' chart for the first `days` days of March"""
+    categories = ','.join(f'"Mar {day}"' for day in range(1, days + 1))
+    cases = ','.join(str(10 * day) for day in range(1, days + 1))
+    page_folder = os.path.join(folder, 'coronavirus', 'country', country)
+    os.makedirs(page_folder, exist_ok=True)
+    path = os.path.join(page_folder, 'index.html')
+    with open(path, 'w') as page:
+        page.write(f"Highcharts.chart('coronavirus-cases-linear', {{ title: {{ text: 'Total Cases' }}, "
+                   f"xAxis: {{ categories: [{categories}] }}, series: [{{ name: 'Cases', data: [{cases}] }}] }});")
+    return path
+
+
+def test_incremental_after_plain_run_does_not_duplicate_days(data_folder):
+    site = data_folder / 'site'
+    server, base_url = serve_folder(site)
+    try:
+        write_country_page(site, 'russia', 3)
+        assert parser.refresh_country('russia', base_url=base_url) == 'written'
+
+        page = write_country_page(site, 'russia', 6)
+        later = os.path.getmtime(page) + 10
+        os.utime(page, (later, later))
+        assert parser.scrape_country('russia', base_url=base_url) == 'written'
+        assert parser.refresh_country('russia', base_url=base_url) == 'appended 0 days'
+    finally:
+        server.shutdown()
+
+    df = pd.read_csv('Data/CovidRussia.csv')
+    assert list(df['time']) == [f'2020-03-0{day}' for day in range(1, 7)]
+    assert list(df['total_cases']) == [10 * day for day in range(1, 7)]
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'worldometer')
+SERIES = ['time', 'total_cases', 'daily_cases', 'total_currently_infected', 'total_death', 'death_per_day',
+          'new_recoveries']
+
+
+def fixture_page(path):
+    with open(os.path.join(FIXTURES, 'coronavirus', path, 'index.html')) as page:
+        return page.read()
+
+
+def write_usa_states(base_url):
+    states = parser.CovidUsaStates(workers=2, rate=0, base_url=base_url)
+    states.write_to_csv()
+    return states.all_states
+
+
+@pytest.mark.parametrize('path', ['country/us', 'usa/new-york', 'usa/texas'])
+def test_extract_series_matches_text_slice_parser(path):
+    text = fixture_page(path)
+    legacy = legacy_parser.Covid(text)
+    legacy.parse()
+    series = parser.extract_series(text)
+    assert [str(day) for day in series['time']] == [str(day) for day in legacy.time]
+    for name in SERIES[1:]:
+        assert list(series.get(name, [])) == getattr(legacy, name), name
+
+
+def test_usa_states_csv_from_worldometer_pages(data_folder):
+    server, base_url = serve_folder(FIXTURES)
+    try:
+        # the table of the us page also links district-of-columbia, whose page is not in the fixtures
+        assert write_usa_states(base_url) == ['district-of-columbia', 'new-york', 'texas']
+    finally:
+        server.shutdown()
+
+    assert not os.path.exists('Data/UsaStates.csv.tmp')
+    df = pd.read_csv('Data/UsaStates.csv')
+    assert list(df.columns) == SERIES + ['state']
+    assert list(df['state']) == ['new-york'] * 8 + ['texas'] * 8
+    assert list(df['time'][:3]) == ['2020-03-12', '2020-03-13', '2020-03-14']
+    assert list(df['total_cases'][:8]) == [328, 421, 528, 740, 975, 1717, 3059, 5400]
+    assert list(df['daily_cases'][8:]) == [0, 16, 13, 16, 12, 25, 89, 89]
+    assert list(df['total_currently_infected'][8:]) == [28, 44, 57, 73, 85, 109, 196, 283]
+    assert list(df['total_death'][:8]) == [0, 0, 3, 10, 18, 24, 41, 67]
+    assert list(df['death_per_day'][8:]) == [0, 0, 0, 0, 0, 0, 2, 2]
+    assert df['new_recoveries'].isna().all()
+
+
+def test_streamed_usa_states_csv_matches_concatenated_one(data_folder):
+    server, base_url = serve_folder(FIXTURES)
+    try:
+        states = write_usa_states(base_url)
+    finally:
+        server.shutdown()
+
+    pages = [(state, fixture_page(f'usa/{state}') if state != 'district-of-columbia' else None) for state in states]
+    legacy_parser.usa_states_frame(pages).to_csv('Data/UsaStatesConcat.csv', index=False)
+    with open('Data/UsaStates.csv') as streamed, open('Data/UsaStatesConcat.csv') as concatenated:
+        assert streamed.read() == concatenated.read()
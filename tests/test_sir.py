@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+import SIR as sir
+
+
+N = 1e7
+STATE = [N, 100, 0]
+
+
+@pytest.mark.parametrize('beta, gamma', [(0.4, 0.05), (0.2, 0.1), (0.3, 0.02), (0.05, 0.04)])
+def test_rk4_trajectory_matches_odeint(beta, gamma):
+    reference = sir.integrate(STATE, 200, (N, beta, gamma))
+    approximate = sir.integrate(STATE, 200, (N, beta, gamma), 'rk4')
+    assert np.max(np.abs(approximate - reference)) / np.max(reference[:, 1]) < 1e-4
+
+
+def test_batch_loss_matches_single_losses():
+    infected = sir.integrate(STATE, 120, (N, 0.3, 0.05))[:, 1] * 1.1
+    recovered = sir.integrate(STATE, 120, (N, 0.3, 0.05))[:, 2] * 0.9
+    points = np.array([[0.4, 0.3, 0.2], [0.05, 0.05, 0.1]])
+    args = (infected, recovered, N, STATE[1], STATE[2])
+    expected = [sir.loss(point, *args) for point in points.T]
+    np.testing.assert_allclose(sir.batch_loss(points, *args), expected, rtol=1e-3)